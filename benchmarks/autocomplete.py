@@ -0,0 +1,55 @@
+"""Measures autocomplete latency per keystroke with lunr search and the prefix index
+
+Every prefix of every subject name is used as a query, simulating a user
+typing the name.
+
+Usage: python benchmarks/autocomplete.py [limit]
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+
+def percentiles(samples):
+    """Returns p50 and p99 in milliseconds"""
+    cuts = statistics.quantiles(samples, n=100)
+    return cuts[49] * 1000, cuts[98] * 1000
+
+
+def measure(func, queries):
+    """Returns the latency of each query"""
+    samples = []
+    for query in queries:
+        start = time.perf_counter()
+        func(query)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def main(limit=5):
+    """Runs benchmark"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.environ["NEWTONCHAT_CACHE"] = tmpdir
+        # pylint: disable=import-outside-toplevel
+        from newtonchat.bots.newton.handlers.subject import SubjectHandler
+        handler = SubjectHandler()
+
+    names = sorted({key.rsplit(" > ", 1)[-1] for key in handler.docmap})
+    queries = [name[:size] for name in names for size in range(1, len(name) + 1)]
+
+    def lunr_search(query):
+        return handler.search(query, limit)
+
+    def prefix_search(query):
+        return handler.complete(query, limit)
+
+    print(f"{len(queries)} queries over {len(handler.docmap)} subjects")
+    for label, func in (("lunr search", lunr_search), ("prefix index", prefix_search)):
+        p50, p99 = percentiles(measure(func, queries))
+        print(f"{label:>12}: p50 {p50:.3f} ms, p99 {p99:.3f} ms")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
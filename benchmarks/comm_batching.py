@@ -0,0 +1,72 @@
+"""Counts comm frames and bytes per user turn with and without batching
+
+Each turn sends a user message to the base chat, which a dummy instance
+also processes, and then marks the replies as read with sync-message.
+
+Usage: python benchmarks/comm_batching.py [turns]
+"""
+import json
+import os
+import sys
+import tempfile
+
+
+QUERIES = ["linear models", "1", "2", "svm", "3", "tree", "1", "nearest neighbors", "4", "1"]
+
+
+class RecordingComm:
+    """Records the size of each sent frame"""
+
+    def __init__(self):
+        self.frames = []
+
+    def send(self, data, buffers=None):
+        """Serializes data as the kernel session would"""
+        size = len(json.dumps(data, default=str).encode('utf-8'))
+        self.frames.append(size + sum(len(buffer) for buffer in buffers or []))
+
+
+def run(turns, batch):
+    """Returns the frames and bytes sent in turns"""
+    # pylint: disable=import-outside-toplevel
+    from newtonchat.comm import kernelcomm
+    kernelcomm.BATCH = batch
+    comm = kernelcomm.KernelComm(None, "newton")
+    comm.comm = RecordingComm()
+    comm.receive({"content": {"data": {
+        "instance": "<meta>", "operation": "new-instance", "name": "dummy", "mode": "dummy",
+    }}})
+    comm.comm.frames.clear()
+    for turn in range(turns):
+        message = {
+            "id": f"user-{turn}", "text": QUERIES[turn % len(QUERIES)], "type": "user",
+            "timestamp": 0, "reply": None, "display": 0, "kernelProcess": 1,
+            "kernelDisplay": 0, "loading": False,
+            "feedback": {"rate": 0, "reason": "", "otherreason": ""},
+        }
+        comm.receive({"content": {"data": {
+            "instance": "base", "operation": "message", "message": message,
+        }}})
+        for name, instance in comm.chat_instances.items():
+            last = instance.history[-1]
+            comm.receive({"content": {"data": {
+                "instance": name, "operation": "sync-message",
+                "message": {"id": last["id"], "new": False},
+            }}})
+    return len(comm.comm.frames), sum(comm.comm.frames)
+
+
+def main(turns=100):
+    """Runs benchmark"""
+    os.environ["NEWTONCHAT_WORKERS"] = "0"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.environ["NEWTONCHAT_CACHE"] = tmpdir
+        for label, batch in (("unbatched", False), ("batched", True)):
+            frames, size = run(turns, batch)
+            print(f"{label:>9}: {frames / turns:.2f} frames/turn, {size / turns:.0f} bytes/turn")
+    # The newton reloader watches the bot sources in a non-daemon thread
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,87 @@
+"""Compares the session JSON encoder with the fast payload encoder
+
+Encodes a full-history payload and a saved-instances payload with 10k
+messages, and checks that the fast encoder output is identical to the
+compact standard library encoding. Both encoders are timed with the
+conversion of ChatMessage objects to wire dicts, as sent by KernelComm.
+Without orjson, the fast encoder is the standard library encoder.
+
+Usage: python benchmarks/comm_serialization.py [messages] [repeat]
+"""
+import json
+import sys
+import time
+
+
+def session_packer(obj):
+    """Encodes obj as the kernel session does"""
+    return json.dumps(obj, ensure_ascii=False, allow_nan=False).encode('utf-8')
+
+
+try:
+    from jupyter_client.session import json_packer as session_packer  # pylint: disable=function-redefined
+except ImportError:
+    pass
+
+
+def create_history(count):
+    """Returns chat messages with the shape of MessageContext.create_message"""
+    # pylint: disable=import-outside-toplevel
+    from newtonchat.comm.message import MessageContext
+    history = []
+    for index in range(count):
+        message = MessageContext.create_message(
+            f"Message {index}: " + "text with ação, ünïcode and \"quotes\" " * (index % 7 + 1),
+            "bot" if index % 2 else "user",
+        )
+        history.append(message)
+    return history
+
+
+def timeit(func, repeat):
+    """Returns the best duration of func"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(count=10000, repeat=5):
+    """Runs benchmark"""
+    # pylint: disable=import-outside-toplevel
+    from newtonchat.comm import serialization
+    history = create_history(count)
+    print(f"{count} messages, fast encoder with {'orjson' if serialization.orjson else 'json'}")
+    payloads = {
+        "sync_chat": {
+            "operation": "init", "history": history, "since": 0, "total": count,
+            "epoch": "epoch", "config": {"show_time": True}, "instance": "base",
+        },
+        "save_instances": {
+            "operation": "instances", "instance": "<meta>", "data": {"instances": {
+                "base": {"name": "base", "mode": "newton", "bot": {}, "history": history,
+                         "config": {"show_time": True}},
+            }, "!!dead_instances": []},
+        },
+    }
+    for name, payload in payloads.items():
+        # KernelComm.transmit converts ChatMessage objects before either encoder runs
+        expected = json.dumps(
+            serialization.to_wire(payload), ensure_ascii=False, separators=(",", ":"),
+            allow_nan=False
+        ).encode('utf-8')
+        session = timeit(
+            lambda: session_packer(serialization.to_wire(payload)), repeat  # pylint: disable=cell-var-from-loop
+        )
+        fast = timeit(
+            lambda: serialization.encode_payload(serialization.to_wire(payload)), repeat  # pylint: disable=cell-var-from-loop
+        )
+        identical = serialization.encode_payload(serialization.to_wire(payload)) == expected
+        print(f"{name:>14}: session {session * 1000:.1f} ms, fast {fast * 1000:.1f} ms, "
+              f"{len(expected) / 1024:.0f} KiB, byte-identical {identical}")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
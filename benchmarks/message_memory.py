@@ -0,0 +1,82 @@
+"""Compares dict messages with ChatMessage objects
+
+Usage: python benchmarks/message_memory.py [messages]
+
+Creates the messages as MessageContext.create_message did before
+ChatMessage (a dict with a uuid4 id, a datetime timestamp, and a nested
+feedback dict) and as it does now. Reports the memory allocated per
+history, measured with tracemalloc, the creation throughput, and the time
+to build the wire dicts of the whole history, which ChatMessage only does
+when the history is sent.
+"""
+import sys
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+
+def legacy_message(text, type_, reply=None, display=0):
+    """Creates a message as MessageContext.create_message did with dicts"""
+    return {
+        "id": str(uuid.uuid4()),
+        "text": text,
+        "type": type_,
+        "timestamp": int(datetime.timestamp(datetime.now())*1000),
+        "reply": reply,
+        "display": int(display),
+        "kernelProcess": 0,
+        "kernelDisplay": 0,
+        "feedback": {
+            "rate": 0,
+            "reason": "",
+            "otherreason": "",
+        },
+        "loading": False,
+    }
+
+
+def create(factory, texts):
+    """Returns the history and the creation time"""
+    start = time.perf_counter()
+    history = [factory(text, "bot") for text in texts]
+    return history, time.perf_counter() - start
+
+
+def measure(factory, texts):
+    """Returns the allocated bytes and the best creation time of a history"""
+    tracemalloc.start()
+    history, _ = create(factory, texts)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del history
+    best = min(create(factory, texts)[1] for _ in range(3))
+    return size, best
+
+
+def main(count=100000):
+    """Runs benchmark"""
+    # pylint: disable=import-outside-toplevel
+    from newtonchat.comm.message import MessageContext
+    from newtonchat.comm.serialization import to_wire
+
+    # Texts are shared by both variants, so only the message overhead is measured
+    texts = [f"Message {index}" for index in range(count)]
+    results = {}
+    for label, factory in (
+        ("dict", legacy_message), ("ChatMessage", MessageContext.create_message)
+    ):
+        size, duration = measure(factory, texts)
+        results[label] = size
+        history, _ = create(factory, texts)
+        start = time.perf_counter()
+        to_wire(history)
+        wire = time.perf_counter() - start
+        print(f"{label:>11}: {size / 2**20:.1f} MiB per {count} messages "
+              f"({size / count:.0f} B/message), {count / duration:,.0f} messages/s, "
+              f"wire dicts {wire * 1000:.1f} ms")
+    print(f"memory ratio: {results['dict'] / results['ChatMessage']:.1f}x")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,56 @@
+"""Compares a per-pattern re.search loop with the RegexHandler matcher
+
+Usage: python benchmarks/regex_matcher.py [copies]
+
+The shipped regexes are replicated copies times, with distinct prefixes, to
+simulate a larger regexes.json. The query only matches a pattern of the
+last copy, which is the worst case for the loop. RegexHandler.match is
+measured with the trigram prefilter and with the precompiled linear loop
+it uses below PREFILTER_MIN_PATTERNS patterns.
+"""
+import re
+import sys
+import timeit
+
+
+def main(copies=20):
+    """Runs benchmark"""
+    # pylint: disable=import-outside-toplevel
+    from newtonchat.bots.newton.handlers import regex as regex_module
+    from newtonchat.bots.newton.handlers.regex import RegexHandler
+
+    handler = RegexHandler()
+    shipped = list(handler.regexes)
+    threshold = regex_module.PREFILTER_MIN_PATTERNS
+    for size in sorted({1, 2, 3, copies // 4 or 1, copies}):
+        handler.regexes = [
+            {**regex, 'regex': f"v{index} " * bool(index) + regex['regex']}
+            for index in reversed(range(size))
+            for regex in shipped
+        ]
+        handler.compile()
+        text = "please filter tokens between 3 and 5 characters from df['text']"
+
+        def loop():
+            for regex in handler.regexes:
+                if re.search(regex['regex'], text):
+                    return regex
+            return None
+
+        number = 200
+        loop_time = min(timeit.repeat(loop, number=number, repeat=5)) / number
+        matcher_times = []
+        for minimum in (len(handler.regexes) + 1, 0):
+            regex_module.PREFILTER_MIN_PATTERNS = minimum
+            matcher_times.append(min(timeit.repeat(
+                lambda: handler.match(text), number=number, repeat=5
+            )) / number)
+        regex_module.PREFILTER_MIN_PATTERNS = threshold
+        used = "prefilter" if len(handler.regexes) >= threshold else "linear"
+        print(f"{len(handler.regexes):5d} patterns: re.search loop {loop_time * 1e6:8.1f} us, "
+              f"precompiled linear {matcher_times[0] * 1e6:8.1f} us, "
+              f"prefilter {matcher_times[1] * 1e6:8.1f} us (match uses {used})")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
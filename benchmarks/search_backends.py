@@ -0,0 +1,65 @@
+"""Compares subject search backends over the shipped data files
+
+Reports, for each backend, the cold build time, the warm (cached) load time,
+the memory allocated by the index of all subject files, and the p50/p99
+query latency.
+
+Usage: python benchmarks/search_backends.py [repeat]
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+def main(repeat=3):
+    """Runs benchmark"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.environ["NEWTONCHAT_CACHE"] = tmpdir
+        # pylint: disable=import-outside-toplevel
+        from newtonchat.bots.newton.handlers.search import BACKENDS
+        from newtonchat.bots.newton.handlers.subject import SubjectHandler, index_digest
+        handler = SubjectHandler()
+        documents = handler.documents()
+        digest = index_digest(handler.sources)
+        names = sorted({key.rsplit(" > ", 1)[-1] for key in handler.docmap})
+        queries = names + [name.split()[0] for name in names]
+
+        print(f"{len(handler.docmap)} documents in {len(handler.sources)} files, "
+              f"{len(queries)} queries")
+        for name, backend in BACKENDS.items():
+            build = min(timeit(lambda: backend.build(  # pylint: disable=cell-var-from-loop
+                documents
+            )) for _ in range(repeat))
+            backend.load(documents, digest)
+            warm = min(timeit(lambda: backend.load(  # pylint: disable=cell-var-from-loop
+                documents, digest
+            )) for _ in range(repeat))
+
+            tracemalloc.start()
+            shard = backend.load(documents, digest)
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+
+            samples = []
+            for query in queries:
+                start = time.perf_counter()
+                backend.search(shard, query)
+                samples.append(time.perf_counter() - start)
+            cuts = statistics.quantiles(samples, n=100)
+            print(f"{name:>8}: build {build * 1000:.1f} ms, load {warm * 1000:.1f} ms, "
+                  f"memory {memory / 1024:.0f} KiB, "
+                  f"query p50 {cuts[49] * 1000:.3f} ms, p99 {cuts[98] * 1000:.3f} ms")
+
+
+def timeit(func):
+    """Returns the duration of a call"""
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,94 @@
+"""Checks that SubjectHandler.search ranks subjects as a single lunr index does
+
+The reference parses the subject files as the handler did before sources
+were split per file and builds one lunr index over all documents. The
+check compares the top-k subjects of every subject name and of its first
+word, and exits with status 1 if any ranking differs.
+
+Usage: python benchmarks/search_ranking.py [k]
+"""
+import json
+import os
+import sys
+import tempfile
+
+
+def reference_documents(data):
+    """Returns the documents of the subject files in the order of the original parser"""
+    documents = []
+    with open(data / 'subjects.json', 'r', encoding='utf-8') as subjects:
+        visit = [('', tree) for tree in json.load(subjects)]
+    while visit:
+        prefix, node = visit.pop()
+        if 'redirect' in node:
+            redirect = {key: value for key, value in node.items() if key != 'redirect'}
+            with open(data / node['redirect'], 'r', encoding='utf-8') as subfile:
+                visit = visit + [(prefix, {**tree, **redirect}) for tree in json.load(subfile)]
+            continue
+        names = node['name'] if isinstance(node['name'], list) else [node['name']]
+        for name in names:
+            key = f"{prefix} > {name}" if prefix else name
+            documents.append({
+                'key': key,
+                'name': name,
+                'description': node.get('description', ''),
+                'keywords': node.get('keywords', ''),
+                'node': node,
+            })
+            for child in node.get('children', []):
+                visit.append((key, child))
+    return documents
+
+
+def reference_search(index, nodes, text, limit):
+    """Returns the keys of the best match of up to limit subjects"""
+    # pylint: disable=import-outside-toplevel
+    from lunr.exceptions import QueryParseError  # type: ignore
+    try:
+        matches = index.search(text)
+    except QueryParseError:
+        matches = []
+    keys = []
+    seen = set()
+    for match in matches:
+        node_id = id(nodes[match['ref']])
+        if node_id not in seen:
+            seen.add(node_id)
+            keys.append(match['ref'])
+            if len(keys) >= limit:
+                break
+    return keys
+
+
+def main(limit=10):
+    """Runs check"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.environ["NEWTONCHAT_CACHE"] = tmpdir
+        # pylint: disable=import-outside-toplevel
+        from lunr import lunr  # type: ignore
+        from newtonchat.bots.newton.handlers.search import INDEX_FIELDS
+        from newtonchat.bots.newton.handlers.subject import SubjectHandler
+        from newtonchat.bots.newton.resources import data
+        handler = SubjectHandler()
+        documents = reference_documents(data())
+        nodes = {document['key']: document['node'] for document in documents}
+        index = lunr(ref='key', fields=INDEX_FIELDS, documents=documents)
+
+        names = sorted({key.rsplit(" > ", 1)[-1] for key in handler.docmap})
+        queries = sorted(set(names + [name.split()[0] for name in names]))
+        different = []
+        for query in queries:
+            expected = reference_search(index, nodes, query, limit)
+            found = [match['ref'] for match, _ in handler.search(query, limit=limit)]
+            if found != expected:
+                different.append((query, expected, found))
+
+    for query, expected, found in different[:10]:
+        print(f"{query!r}:\n  expected {expected}\n  found    {found}")
+    print(f"{len(queries) - len(different)}/{len(queries)} queries rank the top {limit} "
+          f"subjects as the reference")
+    return 1 if different else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*map(int, sys.argv[1:])))
@@ -0,0 +1,32 @@
+"""Measures SubjectHandler startup with a cold and a warm index cache
+
+Usage: python benchmarks/subject_startup.py [repeat]
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+
+def main(repeat=5):
+    """Runs benchmark"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.environ["NEWTONCHAT_CACHE"] = tmpdir
+        # pylint: disable=import-outside-toplevel
+        from newtonchat.bots.newton.handlers.subject import SubjectHandler
+
+        def cold():
+            for cachefile in os.listdir(tmpdir):
+                os.unlink(os.path.join(tmpdir, cachefile))
+            SubjectHandler()
+
+        cold_times = timeit.repeat(cold, number=1, repeat=repeat)
+        SubjectHandler()
+        warm_times = timeit.repeat(SubjectHandler, number=1, repeat=repeat)
+
+    print(f"cold (rebuild index): best {min(cold_times) * 1000:.1f} ms")
+    print(f"warm (cached index):  best {min(warm_times) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -3,6 +3,7 @@ from pathlib import Path
 
 from ._version import __version__
 from .handlers import setup_handlers
+from .shared_index import start_shared_index
 
 
 
@@ -36,6 +37,7 @@ def _load_jupyter_server_extension(server_app):
         JupyterLab application instance
     """
     setup_handlers(server_app.web_app)
+    start_shared_index(server_app.log)
     server_app.log.info("Registered {name} server extension".format(**data))
 
 
@@ -31,7 +31,6 @@ class DummyBot:
     def refresh(self, instance: ChatInstance):
         """Refresh chatbot"""
         # pylint: disable=no-self-use
-        instance.sync_chat("refresh")
 
     def process_message(self, context: MessageContext) -> None:
         """Processes user messages"""
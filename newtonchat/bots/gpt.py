@@ -2,10 +2,22 @@
 from __future__ import annotations
 from typing import TYPE_CHECKING
 
+import threading
+import time
+import traceback
+
 from ..comm.message import MessageContext 
+from .llm import CompletionClient, CompletionError
+from .response_cache import shared_cache
 
 if TYPE_CHECKING:
+    from typing import Iterator
     from ..comm.chat_instance import ChatInstance
+    from ..comm.message import IChatMessage
+
+
+# Minimum interval in seconds between partial reply updates
+UPDATE_INTERVAL = 0.1
 
 
 class GPTBot:
@@ -13,7 +25,8 @@ class GPTBot:
 
     def __init__(self):
         self.prompt = "You are a chatbot that can help programming.\n\nQ: {}\nA:"
-        self.api_key = ""
+        self.client = CompletionClient()
+        self.cache_mode = "auto"
         self.model_config = {}
 
     @classmethod
@@ -99,17 +112,31 @@ class GPTBot:
             "presence_penalty": ('range', {"value": 0, "min": 0, "max": 2, "step": 0.01}),
             "best_of": ('range', {"value": 1, "min": 1, "max": 20, "step": 1}),
             "api_key": ("file", {"value": ""}),
+            "api_base": ("text", {"value": ""}),
+            "timeout": ('range', {"value": 60, "min": 1, "max": 600, "step": 1}),
+            "max_retries": ('range', {"value": 3, "min": 0, "max": 10, "step": 1}),
+            "concurrency": ('range', {"value": 4, "min": 1, "max": 32, "step": 1}),
+            "cache": ('datalist', {"value": "auto", "options": ["auto", "always", "never"]}),
         }
     
     def _set_config(self, original, data, key, convert=str):
         """Sets config"""
-        self.model_config[key] = convert(data.get(key, original[key]))
+        self.model_config[key] = convert(data.get(key, original[key][1]["value"]))
+
+    def _set_client_config(self, original, data, key, convert=str):
+        """Sets client config"""
+        setattr(self.client, key, convert(data.get(key, original[key][1]["value"])))
 
     def start(self, instance: ChatInstance, data: dict):
         """Initializes bot"""
         original = self.config()
         self.prompt = data.get("prompt", self.prompt)
-        self.api_key = data.get("api_key", "").strip()
+        self.client.api_key = data.get("api_key", "").strip()
+        self.client.api_base = data.get("api_base", "").strip()
+        self._set_client_config(original, data, 'timeout', float)
+        self._set_client_config(original, data, 'max_retries', int)
+        self._set_client_config(original, data, 'concurrency', int)
+        self.cache_mode = data.get("cache", self.cache_mode)
         self._set_config(original, data, 'model', str)
         self._set_config(original, data, 'temperature', float)
         self._set_config(original, data, 'max_tokens', int)
@@ -127,30 +154,70 @@ class GPTBot:
     def refresh(self, instance: ChatInstance):
         """Refresh chatbot"""
         # pylint: disable=no-self-use
-        instance.sync_chat("refresh")
 
     def process_message(self, context: MessageContext) -> None:
-        """Processes user messages"""
-        # pylint: disable=unused-argument
-        import openai
-        openai.api_key = self.api_key
-        response = openai.Completion.create(
-          prompt=self.prompt.format(context.text),
-          **self.model_config
-        )
-        try:
-            if response.get("choices") is None or len(response["choices"]) == 0:
-                raise Exception("GPT API returned no choices")
-            text = response["choices"][0].get("text")
-            if text is None:
-                raise Exception("GPT API returned no text")
-            context.reply(text.strip())
-        except Exception:
-            import traceback
-            context.reply(traceback.format_exc(), "error")
-    
+        """Processes user messages in a background thread"""
+        message = context.reply("", loading=True)
+        # The loading reply must reach the client before the thread updates it
+        context.comm.flush()
+        threading.Thread(
+            target=self.complete, args=(context, message), daemon=True
+        ).start()
         return self
 
+    def response_cache(self):
+        """Returns response cache if the current config allows caching
+
+        In auto mode, only deterministic completions (temperature 0) are cached.
+        """
+        if self.cache_mode == "always" or (
+            self.cache_mode == "auto" and float(self.model_config.get("temperature", 1)) == 0
+        ):
+            return shared_cache()
+        return None
+
+    def complete(self, context: MessageContext, message: IChatMessage) -> None:
+        """Requests completion and streams it into message as update-message operations"""
+        instance = context.instance
+        # Every failure must finalize the message, or it would keep loading
+        try:
+            prompt = self.prompt.format(context.text)
+            cache = self.response_cache()
+            key = cache.key(prompt, self.model_config, self.client.api_base) if cache else None
+            if cache and (cached := cache.get(key)) is not None:
+                message['text'] = cached
+                message['loading'] = False
+                instance.update_message(message)
+                return
+            text = ""
+            last_update = time.monotonic()
+            for partial in self.request(prompt):
+                text += partial
+                if text.strip() and time.monotonic() - last_update >= UPDATE_INTERVAL:
+                    message['text'] = text.lstrip()
+                    instance.update_message(message)
+                    last_update = time.monotonic()
+            message['text'] = text.strip()
+            if not message['text']:
+                raise CompletionError("GPT API returned no text")
+            if cache:
+                cache.set(key, message['text'])
+        except Exception:  # pylint: disable=broad-except
+            message['text'] = traceback.format_exc()
+            message['type'] = "error"
+        message['loading'] = False
+        instance.update_message(message)
+
+    def request(self, prompt: str) -> Iterator[str]:
+        """Requests completion and yields the text of each received chunk"""
+        # The API does not support streaming when best_of > 1
+        stream = int(self.model_config.get("best_of", 1)) <= 1
+        payload = {"prompt": prompt, **self.model_config}
+        for chunk in self.client.complete(payload, stream=stream):
+            if not chunk.get("choices"):
+                raise CompletionError("GPT API returned no choices")
+            yield chunk["choices"][0].get("text") or ""
+
     def process_autocomplete(self, instance: ChatInstance, request_id: int, query: str):
         """Processes user autocomplete query"""
         # pylint: disable=unused-argument
@@ -161,13 +228,29 @@ class GPTBot:
             "items": [],
         })
 
+    def stats(self):
+        """Returns client and cache statistics"""
+        cache = self.response_cache()
+        return {
+            "client": self.client.stats(),
+            "cache": cache.stats() if cache else None,
+        }
+
     def save(self):
         """Saves bot"""
         return {
             "config": self.model_config,
             "prompt": self.prompt,
+            "cache": self.cache_mode,
+            "client": {
+                "timeout": self.client.timeout,
+                "max_retries": self.client.max_retries,
+                "concurrency": self.client.concurrency,
+            },
             "!form": {
-                "api_key": ("file", {"value": ""})
+                "api_key": ("file", {"value": ""}),
+                # The user confirms the host that receives the api key
+                "api_base": ("text", {"value": self.client.api_base}),
             }
         }
 
@@ -176,5 +259,12 @@ class GPTBot:
         if "config" in data:
             self.model_config = {**self.model_config, **data["config"]}
         self.prompt = data.get("prompt", self.prompt)
+        self.cache_mode = data.get("cache", self.cache_mode)
+        if client := data.get("client", None):
+            original = self.config()
+            self._set_client_config(original, client, 'timeout', float)
+            self._set_client_config(original, client, 'max_retries', int)
+            self._set_client_config(original, client, 'concurrency', int)
         if form := data.get("!form", None):
-            self.api_key = form.get("api_key", "").strip()
+            self.client.api_key = form.get("api_key", "").strip()
+            self.client.api_base = form.get("api_base", "").strip()
@@ -0,0 +1,156 @@
+"""Defines HTTP client for completion APIs"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+import json
+import random
+import threading
+import time
+
+
+if TYPE_CHECKING:
+    from typing import Iterator
+
+
+DEFAULT_API_BASE = "https://api.openai.com/v1"
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+_SEMAPHORES = {}
+_SEMAPHORES_LOCK = threading.Lock()
+
+
+def key_semaphore(api_key: str, limit: int) -> threading.BoundedSemaphore:
+    """Returns semaphore that limits concurrent requests of all clients that use api_key
+
+    There is one semaphore per key. The first client that uses a key sets
+    its limit, so clients with other concurrency values share that limit.
+    """
+    with _SEMAPHORES_LOCK:
+        if api_key not in _SEMAPHORES:
+            _SEMAPHORES[api_key] = threading.BoundedSemaphore(limit)
+        return _SEMAPHORES[api_key]
+
+
+class CompletionError(Exception):
+    """Raised when the completion API fails"""
+
+
+class CompletionClient:
+    """Client for completion APIs that keeps a pooled HTTP session
+
+    Requests that fail with a connection error, timeout, or a retryable
+    status code are retried with exponential backoff and jitter.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(
+        self,
+        api_key: str = "",
+        api_base: str = "",
+        timeout: float = 60,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        concurrency: int = 4,
+    ):
+        self.api_key = api_key
+        self.api_base = api_base
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.concurrency = concurrency
+        self.session = None
+        self.lock = threading.Lock()
+        self.counters = {
+            "requests": 0,
+            "retries": 0,
+            "failures": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+        }
+
+    def get_session(self):
+        """Returns pooled HTTP session, creating it on first use"""
+        # pylint: disable=import-outside-toplevel
+        with self.lock:
+            if self.session is None:
+                import requests
+                self.session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=max(self.concurrency, 1)
+                )
+                self.session.mount("https://", adapter)
+                self.session.mount("http://", adapter)
+            return self.session
+
+    def count(self, key: str, value: float = 1) -> None:
+        """Increments counter"""
+        with self.lock:
+            self.counters[key] += value
+            if key == "latency_total":
+                self.counters["latency_max"] = max(self.counters["latency_max"], value)
+
+    def stats(self) -> dict:
+        """Returns a snapshot of the counters"""
+        with self.lock:
+            result = dict(self.counters)
+        result["latency_mean"] = result["latency_total"] / (result["requests"] or 1)
+        return result
+
+    def post(self, endpoint: str, payload: dict, stream: bool = False):
+        """Posts payload to endpoint, retrying on retryable failures"""
+        # pylint: disable=import-outside-toplevel
+        import requests
+        session = self.get_session()
+        url = (self.api_base or DEFAULT_API_BASE).rstrip("/") + "/" + endpoint
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        for attempt in range(self.max_retries + 1):
+            delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            try:
+                response = session.post(
+                    url, json=payload, headers=headers, stream=stream, timeout=self.timeout
+                )
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                error = CompletionError(f"Request to {url} failed: {exc}")
+            else:
+                if response.status_code not in RETRY_STATUS:
+                    if not response.ok:
+                        raise CompletionError(
+                            f"Completion API returned {response.status_code}: {response.text}"
+                        )
+                    return response
+                error = CompletionError(
+                    f"Completion API returned {response.status_code}: {response.text}"
+                )
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = max(delay, float(retry_after))
+                response.close()
+            if attempt == self.max_retries:
+                raise error
+            self.count("retries")
+            time.sleep(delay)
+        raise CompletionError("Unreachable")
+
+    def complete(self, payload: dict, stream: bool = False) -> Iterator[dict]:
+        """Requests completion and yields the response chunks"""
+        start = time.monotonic()
+        with key_semaphore(self.api_key, max(self.concurrency, 1)):
+            try:
+                response = self.post("completions", {**payload, "stream": stream}, stream=stream)
+                with response:
+                    if not stream:
+                        yield response.json()
+                        return
+                    for line in response.iter_lines(decode_unicode=True):
+                        if not line or not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+                        yield json.loads(data)
+            except Exception:
+                self.count("failures")
+                raise
+            finally:
+                self.count("requests")
+                self.count("latency_total", time.monotonic() - start)
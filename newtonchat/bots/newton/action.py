@@ -6,7 +6,7 @@ from .states.utils import statemanager
 
 
 if TYPE_CHECKING:
-    from typing import List, Optional
+    from typing import Optional, Sequence
     from ...comm.message import MessageContext, IOptionItem
     from .states.state import StateCallable
 
@@ -15,13 +15,8 @@ if TYPE_CHECKING:
         state: Optional[StateCallable]
 
 
-def show_options(
-    context: MessageContext,
-    options: List[StatefulOption],
-    ordered: bool = True,
-    text: str | None = None
-) -> None:
-    """Shows options that redirect to states"""
+def create_option_selector(options: Sequence[StatefulOption]) -> StateCallable:
+    """Creates state that selects an option by position, key, or label"""
     @statemanager(False)
     def select_option(context: MessageContext):
         """State for option selection"""
@@ -38,4 +33,15 @@ def show_options(
             if option['key'] == text or option['label'].lower() == text.lower():
                 state = option.get('state', None) or no_state
                 return state(context)
+    return select_option
+
+
+def show_options(
+    context: MessageContext,
+    options: Sequence[StatefulOption],
+    ordered: bool = True,
+    text: str | None = None
+) -> None:
+    """Shows options that redirect to states"""
+    select_option = create_option_selector(options)
     context.reply_options(options, ordered=ordered, checkpoint=select_option, text=text)
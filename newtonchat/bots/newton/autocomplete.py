@@ -0,0 +1,107 @@
+"""Defines prefix index for autocompleting subjects"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+import heapq
+import re
+
+
+if TYPE_CHECKING:
+    from typing import Dict, Iterable, List, Tuple
+
+
+# Field weights follow the boosts of the subject lunr index
+AUTOCOMPLETE_FIELDS = (
+    ('name', 10),
+    ('keywords', 7),
+    ('key', 5),
+)
+MAX_PREFIX = 20
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str | Iterable[str]) -> List[str]:
+    """Splits text into lowercase tokens"""
+    if not isinstance(text, str):
+        text = " ".join(text)
+    return TOKEN_RE.findall(text.lower())
+
+
+def autocomplete_items(matches: Iterable[Tuple[str, dict]]) -> List[dict]:
+    """Converts (key, node) pairs into autocomplete response items"""
+    return [{
+        'type': 'subject',
+        'key': key,
+        'value': node.get('description', ''),
+        'url': node.get('url', ''),
+    } for key, node in matches]
+
+
+class AutocompleteIndex:
+    """Prefix index over subject keys, names, and keywords
+
+    Every prefix of every token maps to a postings list sorted by score and
+    to a score map. Queries use the threshold algorithm over the postings of
+    their tokens, so they stop as soon as no unseen subject can enter the
+    top-k results.
+    """
+
+    def __init__(self, docmap: Dict[str, dict] | None = None):
+        self.keys: List[str] = []
+        self.nodes: List[dict] = []
+        self.postings: Dict[str, List[Tuple[int, float]]] = {}
+        self.scores: Dict[str, Dict[int, float]] = {}
+        node_ids: Dict[int, int] = {}
+        for key, document in (docmap or {}).items():
+            node = document['node']
+            doc_id = node_ids.get(id(node))
+            if doc_id is None:
+                doc_id = node_ids[id(node)] = len(self.keys)
+                self.keys.append(key)
+                self.nodes.append(node)
+            self.add(doc_id, document)
+        for prefix, scores in self.scores.items():
+            self.postings[prefix] = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+    def add(self, doc_id: int, document: dict) -> None:
+        """Adds the prefixes of the document tokens to the index"""
+        for field, weight in AUTOCOMPLETE_FIELDS:
+            for position, token in enumerate(tokenize(document.get(field, ''))):
+                for size in range(1, min(len(token), MAX_PREFIX) + 1):
+                    # Prefer prefixes that cover most of the token and
+                    # tokens that appear early in the field
+                    score = weight * size / len(token) / (1 + position)
+                    scores = self.scores.setdefault(token[:size], {})
+                    if scores.get(doc_id, 0) < score:
+                        scores[doc_id] = score
+
+    def search(self, query: str, limit: int = 5) -> List[Tuple[str, dict]]:
+        """Returns up to limit (key, node) pairs that best match the query prefixes"""
+        prefixes = [token[:MAX_PREFIX] for token in tokenize(query)]
+        lists = [self.postings[prefix] for prefix in prefixes if prefix in self.postings]
+        maps = [self.scores[prefix] for prefix in prefixes if prefix in self.scores]
+        if not lists or limit <= 0:
+            return []
+        heap: List[Tuple[float, int]] = []
+        seen = set()
+        for depth in range(max(len(postings) for postings in lists)):
+            threshold = 0.0
+            for postings in lists:
+                if depth >= len(postings):
+                    continue
+                doc_id, score = postings[depth]
+                threshold += score
+                if doc_id in seen:
+                    continue
+                seen.add(doc_id)
+                entry = (sum(scores.get(doc_id, 0) for scores in maps), -doc_id)
+                if len(heap) < limit:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+            if len(heap) == limit and heap[0][0] >= threshold:
+                break
+        return [
+            (self.keys[-doc_id], self.nodes[-doc_id])
+            for _, doc_id in sorted(heap, reverse=True)
+        ]
@@ -3,55 +3,157 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 
 
+import hashlib
 import json
 import re
+from pathlib import Path
+from ..knowledge import REGEX_FILE, knowledge_base
 from ..resources import data
 from ..states.utils import GoToState
-from .utils import HandlerWithPaths
+from .utils import HandlerWithPaths, getmtime
 
 
 if TYPE_CHECKING:
-    from pathlib import Path
     from ....comm.message import MessageContext
     from ..states.state import StateDefinition
 
 
+# Below this number of patterns, trying every pattern is faster than the prefilter
+PREFILTER_MIN_PATTERNS = 40
+
+
+def literal_prefix(pattern: str) -> str:
+    """Returns the literal text that every match of pattern starts with"""
+    result = []
+    position = 0
+    if '|' in pattern:
+        return ""
+    while position < len(pattern):
+        char = pattern[position]
+        if char in "?*{":
+            if result:
+                result.pop()
+            break
+        if char in ".^$+[]()|":
+            break
+        if char == "\\":
+            position += 1
+            if position == len(pattern) or pattern[position].isalnum():
+                break
+            char = pattern[position]
+        result.append(char)
+        position += 1
+    return "".join(result)
+
+
+def parse_regexes(
+    filepath: Path,
+    regexes: list | None = None,
+    files: dict | None = None
+) -> list:
+    """Parses regex definition file and its redirects
+
+    Adds the regexes to regexes, and the content hash and mtime of each file
+    to files.
+    """
+    regexes = [] if regexes is None else regexes
+    files = {} if files is None else files
+    content = filepath.read_bytes()
+    for regex in json.loads(content):
+        if 'redirect' in regex:
+            parse_regexes(data() / regex['redirect'], regexes, files)
+        else:
+            regexes.append(regex)
+    files[filepath] = (hashlib.sha256(content).hexdigest(), getmtime(filepath))
+    return regexes
+
+
 class RegexHandler(HandlerWithPaths):
     """Handler that loads state based on regex"""
 
     def __init__(self):
         self.regexes = []
+        self.compiled = []
+        self.prefilter = {}
+        self.trigrams = None
+        self.unfiltered = []
         super().__init__()
 
     def load_file(self, filepath: Path) -> None:
         """Load regex definition file"""
-        with open(filepath, 'r', encoding='utf-8') as subjects:
-            regexes = json.load(subjects)
-        for regex in regexes:
-            if 'redirect' in regex:
-                self.load_file(data() / regex['redirect'])
-            else:
-                self.regexes.append(regex)
-        self.paths[filepath] = self.getmtime(filepath)
+        files: dict = {}
+        parse_regexes(filepath, self.regexes, files)
+        for path, (_, mtime) in files.items():
+            self.paths[path] = mtime
 
     def inner_reload(self) -> None:
-        """Reloads regexes definition"""
+        """Reloads regexes definition
+
+        Reads the compiled knowledge base when it is available
+        """
         self.regexes = []
         self.paths = {}
-        self.load_file(data() / 'regexes.json')
+        kb = knowledge_base()
+        if kb is not None:
+            self.regexes = kb.regexes()
+            for path, _, kind, mtime in kb.files():
+                if kind == REGEX_FILE:
+                    # The content of files without a compiled mtime was checked by hash
+                    self.paths[Path(path)] = mtime if mtime is not None else getmtime(path)
+        else:
+            self.load_file(data() / 'regexes.json')
+        self.compile()
 
-    def inner_process_message(self, context: MessageContext) -> StateDefinition:
-        """Processes user message"""
-        text = context.text
-        for regex in self.regexes:
-            matches = re.search(regex['regex'], text)
+    def compile(self) -> None:
+        """Precompiles regexes and indexes them by the first trigram of their literal prefix
+
+        A regex that starts with a literal can only match texts that contain
+        the literal. Regexes without a literal prefix of at least 3 characters
+        are checked for every message. The trigrams are found by a single
+        regex with a lookahead, so overlapping occurrences are found in C.
+        """
+        self.compiled = [re.compile(regex['regex']) for regex in self.regexes]
+        self.prefilter = {}
+        self.unfiltered = []
+        for index, regex in enumerate(self.regexes):
+            prefix = literal_prefix(regex['regex'])
+            if len(prefix) >= 3:
+                self.prefilter.setdefault(prefix[:3], []).append(index)
+            else:
+                self.unfiltered.append(index)
+        self.trigrams = None
+        if self.prefilter:
+            self.trigrams = re.compile(
+                "(?=(" + "|".join(re.escape(trigram) for trigram in self.prefilter) + "))"
+            )
+
+    def candidates(self, text: str):
+        """Returns the indexes of regexes that may match text, in definition order"""
+        if len(self.compiled) < PREFILTER_MIN_PATTERNS or self.trigrams is None:
+            return range(len(self.compiled))
+        result = set(self.unfiltered)
+        for trigram in self.trigrams.findall(text):
+            result.update(self.prefilter[trigram])
+        return sorted(result)
+
+    def match(self, text: str):
+        """Returns the first regex definition that matches text and its params"""
+        for index in self.candidates(text):
+            matches = self.compiled[index].search(text)
             if matches:
-                param_defs = regex.get('params', [])
+                regex = self.regexes[index]
                 params = []
-                for param in param_defs:
+                for param in regex.get('params', []):
                     try:
                         params.append(matches.group(param))
                     except IndexError:
                         params.append(None)
-                raise GoToState(regex['state'], params)
+                return regex, params
+        return None
+
+    def inner_process_message(self, context: MessageContext) -> StateDefinition:
+        """Processes user message"""
+        if result := self.match(context.text):
+            regex, params = result
+            raise GoToState(regex['state'], params)
         return None
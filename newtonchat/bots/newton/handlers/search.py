@@ -0,0 +1,549 @@
+"""Defines search backends for subject documents"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from abc import abstractmethod
+import hashlib
+import importlib.util
+import json
+import math
+import os
+import re
+import warnings
+import zipfile
+import zlib
+
+from ...storage import cache
+
+
+if TYPE_CHECKING:
+    from pathlib import Path
+    from typing import Any, Dict, List
+
+
+# Bump it whenever the document list or the index fields change
+INDEX_VERSION = 1
+INDEX_FIELDS = (
+    {'field_name': 'key', 'boost': 5},
+    {'field_name': 'name', 'boost': 10},
+    {'field_name': 'description', 'boost': 1},
+    {'field_name': 'keywords', 'boost': 7}
+)
+DEFAULT_BACKEND = os.environ.get("NEWTONCHAT_SEARCH_BACKEND", "lunr")
+# The bm25, semantic, and hybrid backends require numpy. It is imported on first use
+HAS_NUMPY = importlib.util.find_spec("numpy") is not None
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text: Any) -> List[str]:
+    """Splits text into lowercase tokens"""
+    if not isinstance(text, str):
+        text = " ".join(text)
+    return TOKEN_RE.findall(text.lower())
+
+
+class SearchBackend:
+    """Builds, caches, and queries the index (shard) of the subject documents
+
+    The scores of separate shards are not comparable, so a handler searches
+    one shard over all subject files. A shard must provide search(text),
+    returning the matches as dicts with 'ref' and 'score', sorted by
+    descending score.
+    """
+
+    name = ""
+    suffix = ""
+
+    @abstractmethod
+    def version(self) -> str:
+        """Returns the version of the index format"""
+
+    def available(self) -> bool:
+        """Returns whether the dependencies of the backend are installed"""
+        return True
+
+    @abstractmethod
+    def build(self, documents: List[dict]) -> Any:
+        """Builds shard"""
+
+    @abstractmethod
+    def dump(self, shard: Any, path: Path) -> None:
+        """Writes shard to path"""
+
+    @abstractmethod
+    def restore(self, path: Path, documents: List[dict]) -> Any:
+        """Reads shard of documents from path"""
+
+    def search(self, shard: Any, text: str) -> List[dict]:
+        """Searches shard"""
+        return shard.search(text)
+
+    def cachefile(self, digest: str) -> Path:
+        """Returns cache file of the shard of a documents digest"""
+        key = hashlib.sha256(f"{self.name}:{self.version()}:{digest}".encode('utf-8'))
+        return cache() / f"subjects-{self.prefix()}{key.hexdigest()}{self.suffix}"
+
+    def prefix(self) -> str:
+        """Returns the cache file prefix that distinguishes this backend"""
+        return f"{self.name}-"
+
+    def pattern(self) -> str:
+        """Returns glob pattern of cache files of this backend"""
+        return f"subjects-{self.prefix()}*{self.suffix}"
+
+    def parts(self) -> List[SearchBackend]:
+        """Returns the backends that own the cache files used by this backend"""
+        return [self]
+
+    def load(self, documents: List[dict], digest: str) -> Any:
+        """Restores shard from cache or builds it and stores it in the cache"""
+        cachefile = self.cachefile(digest)
+        try:
+            return self.restore(cachefile, documents)
+        except (OSError, ValueError, KeyError):
+            pass
+        shard = self.build(documents)
+        try:
+            cachefile.parent.mkdir(parents=True, exist_ok=True)
+            tmpfile = cachefile.with_name(f"{cachefile.name}.{os.getpid()}.tmp")
+            self.dump(shard, tmpfile)
+            os.replace(tmpfile, cachefile)
+        except OSError:
+            pass
+        return shard
+
+
+class LunrBackend(SearchBackend):
+    """Lunr full-text search with stemming and field boosts"""
+
+    name = "lunr"
+    suffix = ".json"
+
+    def version(self) -> str:
+        # pylint: disable=import-outside-toplevel
+        from lunr import __VERSION__ as lunr_version  # type: ignore
+        return f"{INDEX_VERSION}:{lunr_version}"
+
+    def build(self, documents):
+        # pylint: disable=import-outside-toplevel
+        from lunr import lunr  # type: ignore
+        return lunr(ref='key', fields=INDEX_FIELDS, documents=documents)
+
+    def dump(self, shard, path):
+        with open(path, 'w', encoding='utf-8') as out:
+            json.dump(shard.serialize(), out)
+
+    def restore(self, path, documents):
+        # pylint: disable=import-outside-toplevel
+        from lunr.index import Index  # type: ignore
+        with open(path, 'r', encoding='utf-8') as cached:
+            return Index.load(json.load(cached))
+
+    def search(self, shard, text):
+        # pylint: disable=import-outside-toplevel
+        from lunr.exceptions import QueryParseError  # type: ignore
+        try:
+            return shard.search(text)
+        except QueryParseError:
+            return []
+
+    def prefix(self):
+        # Lunr shards predate the other backends and keep unprefixed names
+        return ""
+
+
+class BM25Shard:
+    """BM25 index stored as a term-major sparse matrix of precomputed weights"""
+
+    def __init__(self, refs, terms, indptr, indices, weights):
+        # pylint: disable=too-many-arguments
+        self.refs = refs
+        self.terms = terms
+        self.vocabulary = {term: row for row, term in enumerate(terms.tolist())}
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+
+    def search(self, text: str) -> List[dict]:
+        """Returns documents that contain query terms, sorted by BM25 score"""
+        # pylint: disable=import-outside-toplevel
+        import numpy as np
+        rows = {self.vocabulary[token] for token in tokenize(text) if token in self.vocabulary}
+        if not rows:
+            return []
+        slices = [slice(self.indptr[row], self.indptr[row + 1]) for row in rows]
+        scores = np.bincount(
+            np.concatenate([self.indices[part] for part in slices]),
+            weights=np.concatenate([self.weights[part] for part in slices]),
+            minlength=len(self.refs)
+        )
+        matched = np.flatnonzero(scores)
+        order = matched[np.argsort(-scores[matched], kind='stable')]
+        return [
+            {'ref': self.refs[doc], 'score': float(scores[doc])}
+            for doc in order.tolist()
+        ]
+
+
+class BM25Backend(SearchBackend):
+    """NumPy BM25 over field-boosted term frequencies, without stemming"""
+
+    name = "bm25"
+    suffix = ".npz"
+    k1 = 1.2
+    b = 0.75
+
+    def version(self) -> str:
+        return f"{INDEX_VERSION}:1"
+
+    def available(self):
+        return HAS_NUMPY
+
+    def build(self, documents):
+        # pylint: disable=import-outside-toplevel
+        import numpy as np
+        frequencies: List[Dict[str, float]] = []
+        lengths = []
+        for document in documents:
+            counts: Dict[str, float] = {}
+            for spec in INDEX_FIELDS:
+                for token in tokenize(document.get(spec['field_name'], '')):
+                    counts[token] = counts.get(token, 0) + spec['boost']
+            frequencies.append(counts)
+            lengths.append(sum(counts.values()))
+        average = sum(lengths) / (len(lengths) or 1) or 1
+        postings: Dict[str, List[tuple]] = {}
+        for doc, counts in enumerate(frequencies):
+            norm = self.k1 * (1 - self.b + self.b * lengths[doc] / average)
+            for token, count in counts.items():
+                postings.setdefault(token, []).append((doc, count * (self.k1 + 1) / (count + norm)))
+        terms = sorted(postings)
+        indptr = [0]
+        indices: List[int] = []
+        weights: List[float] = []
+        for term in terms:
+            idf = math.log(1 + (len(documents) - len(postings[term]) + 0.5)
+                           / (len(postings[term]) + 0.5))
+            for doc, weight in postings[term]:
+                indices.append(doc)
+                weights.append(idf * weight)
+            indptr.append(len(indices))
+        return BM25Shard(
+            [document['key'] for document in documents],
+            np.array(terms, dtype=str),
+            np.array(indptr, dtype=np.int64),
+            np.array(indices, dtype=np.int32),
+            np.array(weights, dtype=np.float32),
+        )
+
+    def dump(self, shard, path):
+        # pylint: disable=import-outside-toplevel
+        import numpy as np
+        with open(path, 'wb') as out:
+            np.savez(
+                out, refs=np.array(shard.refs, dtype=str), terms=shard.terms,
+                indptr=shard.indptr, indices=shard.indices, weights=shard.weights
+            )
+
+    def restore(self, path, documents):
+        # pylint: disable=import-outside-toplevel
+        import numpy as np
+        try:
+            with np.load(path, allow_pickle=False) as arrays:
+                return BM25Shard(
+                    arrays['refs'].tolist(), arrays['terms'], arrays['indptr'],
+                    arrays['indices'], arrays['weights']
+                )
+        except zipfile.BadZipFile as exc:
+            raise ValueError(f"Invalid shard {path}") from exc
+
+
+def document_text(document: dict) -> str:
+    """Returns the text of a document used by embedding models"""
+    parts = [document.get('key', ''), document.get('description', '')]
+    keywords = document.get('keywords', '')
+    parts.append(keywords if isinstance(keywords, str) else " ".join(keywords))
+    return ". ".join(part for part in parts if part)
+
+
+class HashingEmbedder:
+    """Hashed TF-IDF over words and character trigrams
+
+    Character trigrams match variations of words, such as regressor and
+    regression. Features are hashed with crc32, so vectors do not depend on
+    a vocabulary and queries produce only a few non-zero features.
+    """
+
+    name = "hashing"
+    sparse = True
+
+    def __init__(self, dimensions: int = 1 << 12):
+        self.dimensions = dimensions
+
+    def version(self) -> str:
+        """Returns embedder identification for cache keys"""
+        return f"{self.name}:{self.dimensions}:1"
+
+    def features(self, text: Any, weight: float = 1) -> Dict[int, float]:
+        """Returns hashed feature counts of text"""
+        counts: Dict[int, float] = {}
+        for token in tokenize(text):
+            padded = f"<{token}>"
+            grams = [token] + [f"#{padded[start:start + 3]}" for start in range(len(padded) - 2)]
+            for gram in grams:
+                feature = zlib.crc32(gram.encode('utf-8')) % self.dimensions
+                counts[feature] = counts.get(feature, 0) + weight
+        return counts
+
+    def embed_documents(self, documents: List[dict]):
+        """Returns feature-major matrix whose first column holds the idf of each feature"""
+        # pylint: disable=import-outside-toplevel
+        import numpy as np
+        matrix = np.zeros((self.dimensions, len(documents) + 1), dtype=np.float32)
+        for column, document in enumerate(documents, 1):
+            counts: Dict[int, float] = {}
+            for spec in INDEX_FIELDS:
+                for feature, count in self.features(
+                    document.get(spec['field_name'], ''), spec['boost']
+                ).items():
+                    counts[feature] = counts.get(feature, 0) + count
+            for feature, count in counts.items():
+                matrix[feature, column] = 1 + math.log(count)
+        frequency = np.count_nonzero(matrix[:, 1:], axis=1)
+        matrix[:, 0] = np.log((1 + len(documents)) / (1 + frequency)) + 1
+        matrix[:, 1:] *= matrix[:, :1]
+        norms = np.linalg.norm(matrix[:, 1:], axis=0)
+        matrix[:, 1:] /= np.where(norms > 0, norms, 1)
+        return matrix
+
+    def embed_query(self, text: str, matrix):
+        """Returns the rows of matrix used by the query and their weights"""
+        # pylint: disable=import-outside-toplevel
+        import numpy as np
+        counts = self.features(text)
+        if not counts:
+            return [], np.zeros(0, dtype=np.float32)
+        rows = sorted(counts)
+        weights = np.array([1 + math.log(counts[row]) for row in rows], dtype=np.float32)
+        weights *= matrix[rows, 0]
+        norm = np.linalg.norm(weights)
+        return rows, weights / norm if norm > 0 else weights
+
+
+class ModelEmbedder:
+    """Sentence-transformers model loaded from a local path, running on CPU"""
+
+    name = "model"
+    sparse = False
+
+    def __init__(self, path: str):
+        self.path = path
+        self.model = None
+
+    def version(self) -> str:
+        """Returns embedder identification for cache keys"""
+        return f"{self.name}:{self.path}:1"
+
+    def get_model(self):
+        """Loads model on first use"""
+        if self.model is None:
+            # pylint: disable=import-outside-toplevel
+            from sentence_transformers import SentenceTransformer  # type: ignore
+            self.model = SentenceTransformer(self.path, device="cpu")
+        return self.model
+
+    def embed_documents(self, documents: List[dict]):
+        """Returns dimension-major matrix with an unused first column"""
+        # pylint: disable=import-outside-toplevel
+        import numpy as np
+        vectors = self.get_model().encode(
+            [document_text(document) for document in documents], normalize_embeddings=True
+        )
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(documents), -1)
+        matrix = np.zeros((vectors.shape[1], len(documents) + 1), dtype=np.float32)
+        matrix[:, 1:] = vectors.T
+        return matrix
+
+    def embed_query(self, text: str, matrix):
+        """Returns all rows of matrix and the normalized query embedding"""
+        # pylint: disable=import-outside-toplevel
+        import numpy as np
+        vector = self.get_model().encode([text], normalize_embeddings=True)
+        return slice(None), np.asarray(vector, dtype=np.float32).reshape(-1)
+
+
+def create_embedder():
+    """Returns the local model set by NEWTONCHAT_EMBEDDING_MODEL, or the hashing embedder"""
+    path = os.environ.get("NEWTONCHAT_EMBEDDING_MODEL", "")
+    if path:
+        try:
+            # pylint: disable=import-outside-toplevel,unused-import
+            import sentence_transformers  # type: ignore  # noqa: F401
+            return ModelEmbedder(path)
+        except ImportError:
+            pass
+    return HashingEmbedder()
+
+
+class SemanticShard:
+    """Document embeddings in a memory-mapped feature-major matrix"""
+
+    def __init__(self, embedder, refs: List[str], matrix, threshold: float):
+        self.embedder = embedder
+        self.refs = refs
+        self.matrix = matrix
+        self.threshold = threshold
+
+    def search(self, text: str) -> List[dict]:
+        """Returns documents whose cosine similarity to text reaches the threshold"""
+        # pylint: disable=import-outside-toplevel
+        import numpy as np
+        rows, weights = self.embedder.embed_query(text, self.matrix)
+        if len(weights) == 0 or not self.refs:
+            return []
+        scores = weights @ self.matrix[rows, 1:]
+        matched = np.flatnonzero(scores >= self.threshold)
+        order = matched[np.argsort(-scores[matched], kind='stable')]
+        return [
+            {'ref': self.refs[doc], 'score': float(scores[doc])}
+            for doc in order.tolist()
+        ]
+
+
+class SemanticBackend(SearchBackend):
+    """Embedding similarity search that works offline on CPU
+
+    Uses the local model set by NEWTONCHAT_EMBEDDING_MODEL when
+    sentence-transformers is installed, and hashed TF-IDF otherwise.
+    Matches need a cosine similarity of at least NEWTONCHAT_SEMANTIC_THRESHOLD.
+    """
+
+    name = "semantic"
+    suffix = ".npy"
+
+    def __init__(self):
+        self.embedder = None
+        self.threshold = float(os.environ.get("NEWTONCHAT_SEMANTIC_THRESHOLD", 0.2))
+
+    def get_embedder(self):
+        """Creates embedder on first use"""
+        if self.embedder is None:
+            self.embedder = create_embedder()
+        return self.embedder
+
+    def version(self) -> str:
+        return f"{INDEX_VERSION}:{self.get_embedder().version()}"
+
+    def available(self):
+        return HAS_NUMPY
+
+    def build(self, documents):
+        embedder = self.get_embedder()
+        return SemanticShard(
+            embedder, [document['key'] for document in documents],
+            embedder.embed_documents(documents), self.threshold
+        )
+
+    def dump(self, shard, path):
+        # pylint: disable=import-outside-toplevel
+        import numpy as np
+        with open(path, 'wb') as out:
+            np.save(out, shard.matrix, allow_pickle=False)
+
+    def restore(self, path, documents):
+        # pylint: disable=import-outside-toplevel
+        import numpy as np
+        matrix = np.load(path, mmap_mode='r', allow_pickle=False)
+        if matrix.ndim != 2 or matrix.shape[1] != len(documents) + 1:
+            raise ValueError(f"Invalid shard {path}")
+        return SemanticShard(
+            self.get_embedder(), [document['key'] for document in documents],
+            matrix, self.threshold
+        )
+
+
+class HybridBackend(SearchBackend):
+    """Fuses lunr and semantic results with reciprocal rank fusion
+
+    The shard is a tuple with a shard of each part. load restores them from
+    the cache files of the parts, so they are shared with the lunr and
+    semantic backends. dump and restore write and read each part next to
+    path.
+    """
+
+    name = "hybrid"
+    rank_offset = 60
+
+    def __init__(self, keyword: SearchBackend, semantic: SearchBackend):
+        self.keyword = keyword
+        self.semantic = semantic
+
+    def version(self) -> str:
+        return f"{self.keyword.version()}+{self.semantic.version()}"
+
+    def available(self):
+        return all(part.available() for part in self.parts())
+
+    def parts(self):
+        return [self.keyword, self.semantic]
+
+    def part_path(self, path: Path, part: SearchBackend) -> Path:
+        """Returns the file of a part of the shard stored in path"""
+        return path.with_name(f"{path.name}.{part.name}{part.suffix}")
+
+    def build(self, documents):
+        return tuple(part.build(documents) for part in self.parts())
+
+    def dump(self, shard, path):
+        for part, piece in zip(self.parts(), shard):
+            part.dump(piece, self.part_path(path, part))
+
+    def restore(self, path, documents):
+        return tuple(
+            part.restore(self.part_path(path, part), documents) for part in self.parts()
+        )
+
+    def load(self, documents, digest):
+        return (
+            self.keyword.load(documents, digest),
+            self.semantic.load(documents, digest),
+        )
+
+    def search(self, shard, text):
+        fused: Dict[str, float] = {}
+        for backend, part in zip(self.parts(), shard):
+            for rank, match in enumerate(backend.search(part, text)):
+                fused[match['ref']] = fused.get(match['ref'], 0) + 1 / (self.rank_offset + rank)
+        return [
+            {'ref': ref, 'score': score}
+            for ref, score in sorted(fused.items(), key=lambda item: -item[1])
+        ]
+
+
+BACKENDS: Dict[str, SearchBackend] = {
+    backend.name: backend for backend in (
+        LunrBackend(), BM25Backend(), SemanticBackend()
+    )
+}
+BACKENDS["hybrid"] = HybridBackend(BACKENDS["lunr"], BACKENDS["semantic"])
+
+if DEFAULT_BACKEND not in BACKENDS:
+    DEFAULT_BACKEND = "lunr"
+elif not BACKENDS[DEFAULT_BACKEND].available():
+    warnings.warn(
+        f"Search backend {DEFAULT_BACKEND} requires numpy, which is not installed. "
+        "Using lunr", RuntimeWarning
+    )
+    DEFAULT_BACKEND = "lunr"
+
+
+def available_backends() -> List[str]:
+    """Returns the names of the backends whose dependencies are installed"""
+    return [name for name, backend in BACKENDS.items() if backend.available()]
+
+
+def backend_name(name: str | None) -> str:
+    """Returns name if it is an available backend, or the default backend"""
+    if name in BACKENDS and BACKENDS[name].available():
+        return name
+    return DEFAULT_BACKEND
@@ -1,25 +1,30 @@
 """This module defines the subject state and the subject handler"""
 from __future__ import annotations
 from typing import TYPE_CHECKING
+from dataclasses import dataclass, field
+import hashlib
 import json
-import uuid
 
-from lunr import lunr  # type: ignore
-from lunr.exceptions import QueryParseError  # type: ignore
+from pathlib import Path
 
+from ..autocomplete import AutocompleteIndex
+from ..knowledge import SUBJECT_FILE, knowledge_base
 from ..pagination import pagination
+from ...storage import cache
 from ..resources import data
 from ..states.utils import create_panel_state, create_reply_state, create_state_loader
-from ..states.utils import statemanager
-from ..action import show_options
-from .utils import HandlerWithPaths
+from ..action import create_option_selector
+from .search import BACKENDS, DEFAULT_BACKEND, INDEX_VERSION, backend_name
+from .utils import HandlerWithPaths, getmtime
 
 
 if TYPE_CHECKING:
-    from typing import List, Optional, TypedDict
+    from typing import List, Optional, Tuple, TypedDict
     from ....comm.message import MessageContext
     from ..states.state import StateCallable, StateDefinition
     from ..action import StatefulOption
+    from ..knowledge import KnowledgeBase
+    from ....shared_index import SharedIndexClient
 
 
     class Action(TypedDict, total=False):
@@ -38,6 +43,11 @@ if TYPE_CHECKING:
         children: Optional[List[Subject]]
 
 
+# Maximum number of subjects listed in a reply
+SEARCH_LIMIT = 50
+
+
+
 def subject_name(subject: Subject, key: str | None=None) -> str:
     """Return subject name"""
     if key:
@@ -48,16 +58,89 @@ def subject_name(subject: Subject, key: str | None=None) -> str:
     return name
 
 
-def create_subject_state(subject: Subject, key: str | None=None) -> StateCallable:
-    """Creates state for subject"""
-    name = subject_name(subject, key)
-    if not key:
-        key = str(uuid.uuid4())
-        parent_key = str(uuid.uuid4())
-    else:
-        parent_key = key.rsplit(" > ", 1)[0]
-    @statemanager()
-    def subject_state(context: MessageContext):
+class SubjectNodeState:
+    """State that shows a node of a compiled subject graph"""
+    __slots__ = ('graph', 'node_id')
+    # Precomputed by the graph and shared by all checkpoints
+    checkpoint_shared = True
+
+    def __init__(self, graph: SubjectGraph, node_id: int):
+        self.graph = graph
+        self.node_id = node_id
+
+    def __call__(self, context: MessageContext, *args, **kwargs) -> StateDefinition:
+        node = self.graph.nodes[self.node_id]
+        if not node.options:
+            context.reply(
+                f"Unfortunately, there is nothing in my knowlegde base about {node.name}.",
+                checkpoint=self
+            )
+        else:
+            context.reply_options(node.options, checkpoint=node.selector, text=node.text)
+        return True
+
+
+class SubjectListState:
+    """State that paginates the actions or the children of a subject graph node"""
+    __slots__ = ('graph', 'node_id', 'field', 'theme')
+
+    def __init__(self, graph: SubjectGraph, node_id: int, field_: str, theme: str):
+        self.graph = graph
+        self.node_id = node_id
+        self.field = field_
+        self.theme = theme
+
+    def __call__(self, context: MessageContext, *args, **kwargs) -> StateDefinition:
+        node = self.graph.nodes[self.node_id]
+        items = getattr(node, self.field)
+        text = f"{node.name} has {len(items)} {self.theme}. Please select one:"
+        pagination(context, items, text=text)
+        return True
+
+
+@dataclass(frozen=True)
+class SubjectNode:
+    """Compiled subject with precomputed options"""
+    # pylint: disable=too-many-instance-attributes
+    checkpoint_shared = True
+
+    id: int
+    key: str
+    name: str
+    text: str
+    options: Tuple[StatefulOption, ...]
+    actions: Tuple[StatefulOption, ...]
+    children: Tuple[StatefulOption, ...]
+    selector: StateCallable
+
+
+class SubjectGraph:
+    """Immutable table of subject nodes compiled from the subject documents
+
+    Nodes are identified by integer ids and their states reference them by
+    id, so navigating the graph reuses the precomputed options and states.
+    """
+    checkpoint_shared = True
+
+    def __init__(self, docmap: dict[str, dict] | None = None):
+        docmap = docmap or {}
+        self.ids: dict[str, int] = {key: num for num, key in enumerate(docmap)}
+        self.states = tuple(SubjectNodeState(self, num) for num in range(len(docmap)))
+        self.nodes: Tuple[SubjectNode, ...] = tuple(
+            self.compile_node(num, key, document['node'])
+            for num, (key, document) in enumerate(docmap.items())
+        )
+
+    def state(self, key: str) -> StateCallable | None:
+        """Returns the state of a node by key, if it exists"""
+        node_id = self.ids.get(key)
+        if node_id is None:
+            return None
+        return self.states[node_id]
+
+    def compile_node(self, node_id: int, key: str, subject: Subject) -> SubjectNode:
+        """Compiles the options of a subject"""
+        name = subject_name(subject, key)
         options: List[StatefulOption] = []
         if 'description' in subject:
             options.append({
@@ -71,153 +154,368 @@ def create_subject_state(subject: Subject, key: str | None=None) -> StateCallabl
                 'label': 'Documentation',
                 'state': create_panel_state(subject['url'], name),
             })
-        if subject_parent := subject.get('parent', None):
-            parent_name = subject_name(subject_parent)
-            options.append({
-                'key': parent_key,
-                'label': f'⬆️ {parent_name}',
-                'state': create_subject_state(subject_parent, parent_key)
-            })
-        if subject_actions := subject.get('actions', []):
-            actions: List[StatefulOption] = [{
-                'key': action['state'],
-                'label': action['name'],
-                'state': create_state_loader(action['state'])
-            } for action in subject_actions]
+        if (subject_parent := subject.get('parent', None)) and " > " in key:
+            parent_key = key.rsplit(" > ", 1)[0]
+            if (parent_state := self.state(parent_key)) is not None:
+                options.append({
+                    'key': parent_key,
+                    'label': f'⬆️ {subject_name(subject_parent)}',
+                    'state': parent_state
+                })
+        actions: Tuple[StatefulOption, ...] = tuple({
+            'key': action['state'],
+            'label': action['name'],
+            'state': create_state_loader(action['state'])
+        } for action in subject.get('actions', None) or [])
+        if actions:
             options.append({
                 'key': f"{key}::actions",
                 'label': 'Actions',
-                'state': create_state_list(name, actions, "action(s)")
+                'state': SubjectListState(self, node_id, 'actions', "action(s)")
             })
-        if subject_children := subject.get('children', []):
-            children: List[StatefulOption] = []
-            children_names = []
-            for child in subject_children:
-                child_name = subject_name(child)
-                children_names.append(child_name)
-                child_key = f"{key} > {child_name}"
+        children: List[StatefulOption] = []
+        children_names = []
+        for child in subject.get('children', None) or []:
+            child_name = subject_name(child)
+            children_names.append(child_name)
+            child_key = f"{key} > {child_name}"
+            if (child_state := self.state(child_key)) is not None:
                 children.append({
                     'key': child_key,
                     'label': child_name,
-                    'state': create_subject_state(child, child_key)
+                    'state': child_state
                 })
+        if children_names:
             options.append({
                 'key': f"{key}::children",
                 'label': f'⬇️ {", ".join(children_names)}',
-                'state': create_state_list(name, children, "child subject(s)")
+                'state': SubjectListState(self, node_id, 'children', "child subject(s)")
             })
+        return SubjectNode(
+            id=node_id,
+            key=key,
+            name=name,
+            text=f"What do you want to know about {name}?",
+            options=tuple(options),
+            actions=actions,
+            children=tuple(children),
+            selector=create_option_selector(options),
+        )
 
-        if not options:
-            context.reply(
-                f"Unfortunately, there is nothing in my knowlegde base about {name}.",
-                checkpoint=subject_state
-            )
-        else:
-            show_options(context, options, text=f"What do you want to know about {name}?")
-    return subject_state
 
+@dataclass
+class SubjectSource:
+    """Represents a subject file and the documents it contributes to the index"""
+    # pylint: disable=too-many-instance-attributes
+
+    filepath: Path
+    prefix: str = ''
+    extra: dict = field(default_factory=dict)
+    digest: str = ''
+    documents: List[dict] = field(default_factory=list)
+    redirects: List[Path] = field(default_factory=list)
+
+
+def source_digest(source: SubjectSource, content_hash: str) -> str:
+    """Returns a hash that identifies the documents of a subject file"""
+    extra = {key: value for key, value in source.extra.items() if key != 'parent'}
+    digest = hashlib.sha256(f"{INDEX_VERSION}".encode('utf-8'))
+    digest.update(content_hash.encode('utf-8'))
+    digest.update(source.prefix.encode('utf-8'))
+    digest.update(json.dumps(extra, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
 
-def create_state_list(name: str, children: List[StatefulOption], theme: str) -> StateCallable:
-    """Creates state for list of children of subject"""
-    @statemanager()
-    def children_state(context: MessageContext) -> StateDefinition:
-        text = f"{name} has {len(children)} {theme}. Please select one:"
-        pagination(context, children, text=text)
-        return None
-    return children_state
+
+def index_digest(sources: dict) -> str:
+    """Returns a hash that identifies the documents of all subject files, in order"""
+    digest = hashlib.sha256(f"{INDEX_VERSION}".encode('utf-8'))
+    for source in sources.values():
+        digest.update(source.digest.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def parse_subjects(
+    filepath: Path,
+    prefix: str = '',
+    extra: dict | None = None,
+    sources: dict | None = None,
+    docmap: dict | None = None,
+    files: dict | None = None
+) -> SubjectSource:
+    """Parses subject file and its redirects
+
+    Adds a SubjectSource per file to sources, the documents to docmap, and
+    the content hash and mtime of each file to files.
+    """
+    # pylint: disable=too-many-arguments
+    sources = {} if sources is None else sources
+    docmap = {} if docmap is None else docmap
+    files = {} if files is None else files
+    content = filepath.read_bytes()
+    files[filepath] = (hashlib.sha256(content).hexdigest(), getmtime(filepath))
+    source = SubjectSource(filepath, prefix, extra or {})
+    sources[filepath] = source
+
+    visit = [(prefix, {**tree, **source.extra}) for tree in json.loads(content)]
+    while visit:
+        current = visit.pop()
+        if 'redirect' in current[1]:
+            subpath = data() / current[1]['redirect']
+            del current[1]['redirect']
+            source.redirects.append(subpath)
+            parse_subjects(subpath, current[0], current[1], sources, docmap, files)
+            continue
+        names = current[1]['name']
+        if isinstance(names, str):
+            names = [names]
+        for name in names:
+            key = name
+            if current[0]:
+                key = current[0] + ' > ' + key
+            document = {
+                'key': key,
+                'name': name,
+                'description': current[1].get('description', ''),
+                'keywords': current[1].get('keywords', ''),
+                'node': current[1],
+            }
+            source.documents.append(document)
+            docmap[key] = document
+            for child in current[1].get('children', []):
+                child['parent'] = current[1]
+                visit.append((key, child))
+
+    source.digest = source_digest(source, files[filepath][0])
+    return source
 
 
 class SubjectHandler(HandlerWithPaths):
     """Provides functions for searching a subject"""
 
-    def __init__(self):
+    def __init__(self, remote: SharedIndexClient | None = None):
         self.docmap = {}
-        self.idx = None
+        self.sources = {}
+        self.remote = remote
+        # Scores of separate indexes are not comparable, so each backend
+        # searches one index over the documents of all subject files.
+        # With a shared index, the local index is only built as a fallback
+        self.indexes = {DEFAULT_BACKEND: None} if remote is None else {}
+        self.hashes = {}
+        self.kb = None
+        self.graph = SubjectGraph()
+        self.autocomplete: AutocompleteIndex | None = AutocompleteIndex()
         super().__init__()
 
-    def build_document_list(self, forest):
-        """Builds document list to use lurn for searching"""
-        docmap = {}
-        documents = []
-
-        visit = [('', tree) for tree in forest]
-        while visit:
-            current = visit.pop()
-            if 'redirect' in current[1]:
-                filepath = data() / current[1]['redirect']
-                del current[1]['redirect']
-                with open(filepath, 'r', encoding='utf-8') as subfile:
-                    subvisit = [(current[0], {**tree, **current[1]}) for tree in json.load(subfile)]
-                    visit = visit + subvisit
-                    print(subvisit)
-                self.paths[filepath] = self.getmtime(filepath)
-                continue
-            names = current[1]['name']
-            if isinstance(names, str):
-                names = [names]
-            for name in names:
-                key = name
-                if current[0]:
-                    key = current[0] + ' > ' + key
-                document = {
-                    'key': key,
-                    'name': name,
-                    'description': current[1].get('description', ''),
-                    'keywords': current[1].get('keywords', ''),
-                    'node': current[1],
-                }
-                documents.append(document)
-                docmap[key] = document
-                for child in current[1].get('children', []):
-                    child['parent'] = current[1]
-                    visit.append((key, child))
-        return docmap, documents
+    def load_source(self, filepath, prefix='', extra=None) -> SubjectSource:
+        """Parses subject file and its redirects into separate sources"""
+        sources: dict = {}
+        files: dict = {}
+        source = parse_subjects(filepath, prefix, extra, sources, self.docmap, files)
+        for path, (digest, mtime) in files.items():
+            self.hashes[path] = digest
+            self.paths[path] = mtime
+        self.sources.update(sources)
+        return source
+
+    def documents(self) -> List[dict]:
+        """Returns the documents of all subject files, in order"""
+        return [document for source in self.sources.values() for document in source.documents]
+
+    def load_indexes(self) -> None:
+        """Loads the index of every loaded backend
+
+        Indexes of the knowledge base are loaded on first search, so startup
+        does not parse them.
+        """
+        self.indexes = {
+            name: None if self.kb is not None else self.load_index(name)
+            for name in self.indexes
+        }
+
+    def load_index(self, name: str):
+        """Loads the index of a backend, reading the knowledge base when it has one
+
+        Indexes are cached by the digest of all subject files, so a change
+        in any file rebuilds the index, but reverting it reuses the cache.
+        """
+        if self.kb is not None:
+            try:
+                index = self.kb.index(name)
+            except ImportError:
+                index = None
+            if index is not None:
+                return index
+        return BACKENDS[name].load(self.documents(), index_digest(self.sources))
+
+    def unload_source(self, filepath) -> None:
+        """Removes the documents of a subject file and its redirects"""
+        source = self.sources.pop(filepath, None)
+        if source is None:
+            return
+        for subpath in source.redirects:
+            self.unload_source(subpath)
+        for document in source.documents:
+            if self.docmap.get(document['key']) is document:
+                del self.docmap[document['key']]
+        self.hashes.pop(filepath, None)
+        self.paths.pop(filepath, None)
+
+    def backend_index(self, name: str):
+        """Returns the index of a search backend, building it on first use"""
+        if self.indexes.get(name) is None:
+            self.indexes[name] = self.load_index(name)
+        return self.indexes[name]
+
+    def prune_cache(self) -> None:
+        """Removes cached indexes of the loaded backends that are not used anymore"""
+        backends = {part.name: part for name in self.indexes for part in BACKENDS[name].parts()}
+        digest = index_digest(self.sources)
+        for backend in backends.values():
+            used = {backend.cachefile(digest).name}
+            try:
+                for oldfile in cache().glob(backend.pattern()):
+                    if oldfile.name not in used:
+                        oldfile.unlink(missing_ok=True)
+            except OSError:
+                pass
 
     def inner_reload(self) -> None:
-        """Reloads lunr indexes based on subjects file"""
-        filepath = data() / 'subjects.json'
-        with open(filepath, 'r', encoding='utf-8') as subjects:
-            forest = json.load(subjects)
-        self.docmap, documents = self.build_document_list(forest)
-        self.idx = lunr(ref='key', fields=(
-            {'field_name': 'key', 'boost': 5},
-            {'field_name': 'name', 'boost': 10},
-            {'field_name': 'description', 'boost': 1},
-            {'field_name': 'keywords', 'boost': 7}
-        ), documents=documents)
-        self.paths[filepath] = self.getmtime(filepath)
+        """Reloads search indexes based on subjects file
+
+        Reads the compiled knowledge base when it is available
+        """
+        self.docmap = {}
+        self.sources = {}
+        self.hashes = {}
+        self.kb = knowledge_base()
+        if self.kb is not None:
+            self.load_knowledge_base(self.kb)
+        else:
+            self.load_source(data() / 'subjects.json')
+        self.load_indexes()
+        self.graph = SubjectGraph(self.docmap)
+        self.autocomplete = AutocompleteIndex(self.docmap) if self.remote is None else None
+        self.prune_cache()
+
+    def load_knowledge_base(self, kb: KnowledgeBase) -> None:
+        """Loads documents and sources from the knowledge base"""
+        self.docmap = kb.docmap
+        for path, digest, kind, mtime in kb.files():
+            if kind == SUBJECT_FILE:
+                self.hashes[Path(path)] = digest
+                # The content of files without a compiled mtime was checked by hash
+                self.paths[Path(path)] = mtime if mtime is not None else getmtime(path)
+        for path, prefix, digest, documents, redirects in kb.sources():
+            source = SubjectSource(
+                Path(path), prefix, {}, digest, documents, [Path(sub) for sub in redirects]
+            )
+            self.sources[source.filepath] = source
+
+    def reload_paths(self, filepaths) -> None:
+        """Reparses only the changed subject files and reloads the indexes"""
+        if self.kb is not None:
+            self.detach_knowledge_base()
+            return
+        previous = dict(self.sources)
+        for filepath in filepaths:
+            source = previous.get(filepath)
+            if source is None or self.sources.get(filepath) is not source:
+                # Already reloaded as a redirect of another changed file
+                continue
+            self.unload_source(filepath)
+            self.load_source(filepath, source.prefix, source.extra)
+        # Keep the file order, so the index matches the one of a full reload
+        order = {filepath: position for position, filepath in enumerate(previous)}
+        self.sources = dict(sorted(
+            self.sources.items(), key=lambda item: order.get(item[0], len(order))
+        ))
+        self.load_indexes()
+        self.graph = SubjectGraph(self.docmap)
+        self.autocomplete = AutocompleteIndex(self.docmap) if self.remote is None else None
+        self.prune_cache()
+
+    def detach_knowledge_base(self) -> None:
+        """Reparses the subject files without the knowledge base
+
+        The knowledge base does not keep the redirect fields that changed
+        files need to be reparsed on their own, so all files are reparsed.
+        The knowledge base is recompiled on the next full reload.
+        """
+        self.kb = None
+        self.docmap = {}
+        self.hashes = {}
+        self.paths = {}
+        self.sources = {}
+        files: dict = {}
+        parse_subjects(data() / 'subjects.json', sources=self.sources, docmap=self.docmap,
+                       files=files)
+        for path, (digest, mtime) in files.items():
+            self.hashes[path] = digest
+            self.paths[path] = mtime
+        self.load_indexes()
+        self.graph = SubjectGraph(self.docmap)
+        self.autocomplete = AutocompleteIndex(self.docmap) if self.remote is None else None
+        self.prune_cache()
 
     def inner_process_message(self, context: MessageContext) -> StateDefinition:
         """Processes users message"""
-        matches = list(self.search(context.text))
+        backend = backend_name(context.instance.config.get("search_backend"))
+        matches = self.search(context.text, limit=SEARCH_LIMIT + 1, backend=backend)
         if matches:
-            text = (f"I found {len(matches)} subjects. "
-                    f"Which one of these best describe your query?")
-            pagination(context, [{
-                'key': match['ref'],
-                'label': subject_name(node['name'], match['ref']),
-                'state': create_subject_state(node, key=match['ref'])
-            } for match, node in matches], text=text)
+            if len(matches) > SEARCH_LIMIT:
+                matches = matches[:SEARCH_LIMIT]
+                text = (f"I found more than {SEARCH_LIMIT} subjects. "
+                        f"Which one of these best describe your query?")
+            else:
+                text = (f"I found {len(matches)} subjects. "
+                        f"Which one of these best describe your query?")
+            graph = self.graph
+            pagination(context, matches, text=text, build=lambda result: {
+                'key': result[0]['ref'],
+                'label': subject_name(result[1], result[0]['ref']),
+                'state': graph.state(result[0]['ref'])
+            })
             return True
         return None
 
-    def search(self, text):
-        """Searches subject based on input text"""
-        try:
-            matches = self.idx.search(text)
-        except QueryParseError:
-            matches = []
+    def search(self, text, limit=None, backend=DEFAULT_BACKEND):
+        """Searches subject based on input text
+
+        Returns up to limit (match, node) pairs, keeping only the best match
+        of each subject. Queries the shared index first, if there is one.
+        """
+        results = None
+        if self.remote is not None:
+            results = self.remote.search(text, limit, backend)
+        if results is None:
+            results = BACKENDS[backend].search(self.backend_index(backend), text)
+        matches = []
         node_ids = set()
-        for match in matches:
+        for match in results:
+            if limit is not None and len(matches) >= limit:
+                break
+            if match['ref'] not in self.docmap:
+                continue
             node = self.docmap[match['ref']]['node']
             node_id = id(node)
             if node_id not in node_ids:
                 node_ids.add(node_id)
-                yield (match, node)
+                matches.append((match, node))
+        return matches
+
+    def complete(self, text, limit=5):
+        """Returns (key, node) pairs of subjects that start with the words of text
+
+        Queries the shared index first, if there is one.
+        """
+        if self.remote is not None:
+            keys = self.remote.complete(text, limit)
+            if keys is not None:
+                return [(key, self.docmap[key]['node']) for key in keys if key in self.docmap]
+        if self.autocomplete is None:
+            self.autocomplete = AutocompleteIndex(self.docmap)
+        return self.autocomplete.search(text, limit)
 
     def state_by_key(self, key) -> StateDefinition:
         """Return subject state by key, if it exists"""
-        if key in self.docmap:
-            node = self.docmap[key]['node']
-            return create_subject_state(node, key=key)
-        return None
+        return self.graph.state(key)
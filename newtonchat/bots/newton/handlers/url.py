@@ -11,6 +11,7 @@ if TYPE_CHECKING:
 class URLHandler:
     """Handler that opens Panel if user types a URL"""
     # pylint: disable=too-few-public-methods
+    checkpoint_shared = True
 
     def process_message(self, context: MessageContext) -> StateDefinition:
         """Processes user message"""
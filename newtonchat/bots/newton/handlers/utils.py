@@ -5,30 +5,58 @@ from typing import TYPE_CHECKING
 from abc import abstractmethod
 import os
 
+from .watcher import WATCHER
+
 
 if TYPE_CHECKING:
     from ....comm.message import MessageContext
     from ..states.state import StateDefinition
 
 
+def getmtime(path):
+    """Returns the modification time of a file, or None if it does not exist"""
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
 class HandlerWithPaths:
     """Handle changes on loaded data files"""
+    checkpoint_shared = True
 
     def __init__(self):
         self.paths = {}
+        self.dirty = False
         self.reload()
+        WATCHER.register(self)
 
     def reload(self) -> None:
         """Reloads paths"""
         self.paths = {}
         self.inner_reload()
 
+    def changed_paths(self):
+        """Returns the monitored files that changed since they were loaded"""
+        return [
+            filepath for filepath, oldtime in list(self.paths.items())
+            if oldtime != self.getmtime(filepath)
+        ]
+
     def check_updates(self) -> None:
-        """Checks if any of the monitored files has changed"""
-        for filepath, oldtime in self.paths.items():
-            if oldtime != self.getmtime(filepath):
-                self.reload()
-                break
+        """Reloads monitored files if the shared watcher flagged a change"""
+        WATCHER.poll()
+        if not self.dirty:
+            return
+        self.dirty = False
+        if changed := self.changed_paths():
+            self.reload_paths(changed)
+            WATCHER.register(self)
+
+    def reload_paths(self, filepaths) -> None:
+        """Reloads after changes on filepaths. Subclasses may reload only what changed"""
+        # pylint: disable=unused-argument
+        self.reload()
 
     def process_message(self, context: MessageContext) -> StateDefinition:
         """Processes users message"""
@@ -38,10 +66,7 @@ class HandlerWithPaths:
     def getmtime(self, path):
         """Returns the mofication time of a file"""
         # pylint: disable=no-self-use
-        try:
-            return os.path.getmtime(path)
-        except OSError:
-            return None
+        return getmtime(path)
 
     @abstractmethod
     def inner_reload(self) -> None:
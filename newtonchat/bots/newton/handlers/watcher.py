@@ -0,0 +1,104 @@
+"""Shared service that watches data files of handlers"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+import os
+import threading
+import time
+import weakref
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+if TYPE_CHECKING:
+    from .utils import HandlerWithPaths
+
+
+class FileWatcher:
+    """Flags handlers as dirty when their files change
+
+    Uses pyinotify when it is available. File modification times are also
+    polled at most once per interval seconds, since inotify does not see
+    changes made by other hosts on network filesystems. The interval can
+    be set with NEWTONCHAT_WATCH_INTERVAL.
+    """
+
+    def __init__(self, interval: float | None = None):
+        if interval is None:
+            interval = float(os.environ.get("NEWTONCHAT_WATCH_INTERVAL", 2))
+        self.interval = interval
+        self.handlers: weakref.WeakSet[HandlerWithPaths] = weakref.WeakSet()
+        self.last_poll = time.monotonic()
+        self.lock = threading.Lock()
+        self.directories = set()
+        self.manager = None
+        if pyinotify is not None:
+            try:
+                self.manager = pyinotify.WatchManager()
+                notifier = pyinotify.ThreadedNotifier(
+                    self.manager, default_proc_fun=_WatcherEvent(watcher=self)
+                )
+                notifier.daemon = True
+                notifier.start()
+            except Exception:  # pylint: disable=broad-except
+                self.manager = None
+
+    @property
+    def active(self) -> bool:
+        """Indicates whether file events are delivered by inotify"""
+        return self.manager is not None
+
+    def register(self, handler: HandlerWithPaths) -> None:
+        """Watches the directories of all handler paths"""
+        with self.lock:
+            self.handlers.add(handler)
+            if not self.active:
+                return
+            mask = (
+                pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE
+                | pyinotify.IN_DELETE | pyinotify.IN_MOVED_TO
+            )
+            for filepath in list(handler.paths):
+                directory = os.path.dirname(str(filepath))
+                if directory not in self.directories:
+                    self.manager.add_watch(directory, mask)
+                    self.directories.add(directory)
+
+    def notify(self, pathname: str) -> None:
+        """Flags handlers that monitor pathname"""
+        with self.lock:
+            handlers = list(self.handlers)
+        for handler in handlers:
+            if any(str(filepath) == pathname for filepath in list(handler.paths)):
+                handler.dirty = True
+
+    def poll(self) -> None:
+        """Checks modification times if the interval expired, even if inotify is active"""
+        now = time.monotonic()
+        if now - self.last_poll < self.interval:
+            return
+        self.last_poll = now
+        with self.lock:
+            handlers = list(self.handlers)
+        for handler in handlers:
+            if not handler.dirty and handler.changed_paths():
+                handler.dirty = True
+
+
+if pyinotify is not None:
+    class _WatcherEvent(pyinotify.ProcessEvent):
+        """Forwards inotify events to the FileWatcher"""
+
+        def my_init(self, watcher=None, **kwargs):
+            """Initializes variables to use on process notification"""
+            # pylint: disable=arguments-differ
+            self._watcher = watcher
+
+        def process_default(self, event):
+            self._watcher.notify(event.pathname)
+
+
+WATCHER = FileWatcher()
@@ -0,0 +1,643 @@
+"""Defines the compiled knowledge base and its memory-mapped reader
+
+The knowledge base stores the subject forest, the regexes, and the BM25
+and lunr indexes of the subject documents in a single binary file. Strings
+are kept in a string table and subjects, documents, and regexes are
+fixed-width records that reference strings and other records by index.
+Handlers read the file through mmap, so kernels on the same host share its
+pages and startup does not parse JSON.
+
+The BM25 arrays are used in place. Lunr can only search its own objects,
+so the serialized lunr index is parsed on the first search of a kernel,
+and the parsed index is not shared. Kernels share one parsed lunr index
+with NEWTONCHAT_SHARED_INDEX. The file is compiled by
+compile_knowledge_base when a handler finds it missing or stale.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from bisect import bisect_left
+from collections.abc import Mapping, Sequence
+import hashlib
+import json
+import math
+import mmap
+import os
+from pathlib import Path
+import struct
+import threading
+import weakref
+
+from ..storage import cache
+from .resources import data
+
+
+if TYPE_CHECKING:
+    from typing import Any, Dict, Iterator, List, Tuple
+
+
+MAGIC = b"NKB1"
+KB_VERSION = 2
+HEADER = struct.Struct("<4sHH")
+SECTION = struct.Struct("<8sQQ")
+U32 = struct.Struct("<I")
+# path, content hash, kind, mtime (NaN if unknown)
+FILE = struct.Struct("<IIId")
+# path, prefix, digest, first document, documents, first redirect, redirects
+SOURCE = struct.Struct("<IIIIIII")
+# flags, first name, names, description, url, keywords, parent,
+# first child, children, first action, actions
+SUBJECT = struct.Struct("<IIIiiiiIIII")
+# key, name, subject
+DOCUMENT = struct.Struct("<III")
+# name, state
+ACTION = struct.Struct("<II")
+# regex, state, first param, params
+REGEX = struct.Struct("<IIII")
+# kind, value
+PARAM = struct.Struct("<Bi")
+# first term, terms, first posting, postings
+BM25_INDEX = struct.Struct("<IIQQ")
+
+SUBJECT_FILE, REGEX_FILE = 0, 1
+NAME_LIST = 1
+PARAM_INT, PARAM_STR = 0, 1
+NONE = -1
+UNKNOWN_MTIME = float("nan")
+
+
+def knowledge_path() -> Path:
+    """Returns the path of the knowledge base of the current data directory"""
+    digest = hashlib.sha256(str(data()).encode('utf-8')).hexdigest()[:16]
+    return cache() / f"knowledge-{digest}.nkb"
+
+
+class KnowledgeBaseWriter:
+    """Collects tables and writes them as a knowledge base file"""
+
+    def __init__(self):
+        self.strings: Dict[str, int] = {}
+        self.sections: Dict[str, List[bytes]] = {}
+
+    def string(self, value: str | None) -> int:
+        """Returns the index of value in the string table"""
+        if value is None:
+            return NONE
+        if value not in self.strings:
+            self.strings[value] = len(self.strings)
+        return self.strings[value]
+
+    def add(self, section: str, record: bytes) -> int:
+        """Appends record to section and returns its index"""
+        records = self.sections.setdefault(section, [])
+        records.append(record)
+        return len(records) - 1
+
+    def count(self, section: str) -> int:
+        """Returns the number of records of a section"""
+        return len(self.sections.get(section, []))
+
+    def write(self, path: Path) -> None:
+        """Writes file atomically"""
+        blob = bytearray()
+        offsets = [0]
+        for value in self.strings:
+            blob += value.encode('utf-8')
+            offsets.append(len(blob))
+        sections = {
+            "stroff": struct.pack(f"<{len(offsets)}I", *offsets),
+            "strdat": bytes(blob),
+            **{name: b"".join(records) for name, records in self.sections.items()},
+        }
+        position = HEADER.size + SECTION.size * len(sections)
+        table = []
+        for name, content in sections.items():
+            position += -position % 8
+            table.append((name, position, content))
+            position += len(content)
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmpfile = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmpfile, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, KB_VERSION, len(sections)))
+            for name, offset, content in table:
+                out.write(SECTION.pack(name.encode('ascii'), offset, len(content)))
+            for name, offset, content in table:
+                out.write(b"\0" * (offset - out.tell()))
+                out.write(content)
+        os.replace(tmpfile, path)
+
+
+def compile_knowledge_base(path: Path | None = None) -> Path:
+    """Parses the data files and compiles them into a knowledge base file"""
+    # pylint: disable=import-outside-toplevel,too-many-locals
+    from .handlers.regex import parse_regexes
+    from .handlers.search import BACKENDS
+    from .handlers.subject import index_digest, parse_subjects
+    path = path or knowledge_path()
+    sources: dict = {}
+    docmap: dict = {}
+    files: dict = {}
+    regex_files: dict = {}
+    parse_subjects(data() / 'subjects.json', sources=sources, docmap=docmap, files=files)
+    regexes = parse_regexes(data() / 'regexes.json', files=regex_files)
+
+    writer = KnowledgeBaseWriter()
+    for kind, entries in ((SUBJECT_FILE, files), (REGEX_FILE, regex_files)):
+        for filepath, (digest, mtime) in entries.items():
+            writer.add("files", FILE.pack(
+                writer.string(str(filepath)), writer.string(digest), kind,
+                UNKNOWN_MTIME if mtime is None else mtime
+            ))
+
+    # Subjects include the nodes reachable from documents, such as redirects
+    subjects: Dict[int, int] = {}
+    nodes: List[dict] = []
+    visit = [document['node'] for document in docmap.values()]
+    while visit:
+        node = visit.pop()
+        if id(node) in subjects:
+            continue
+        subjects[id(node)] = len(nodes)
+        nodes.append(node)
+        visit.extend(node.get('children', None) or [])
+        if node.get('parent', None) is not None:
+            visit.append(node['parent'])
+    for node in nodes:
+        names = node['name'] if isinstance(node['name'], list) else [node['name']]
+        first_name = writer.count("names")
+        for name in names:
+            writer.add("names", U32.pack(writer.string(name)))
+        first_child = writer.count("children")
+        for child in node.get('children', None) or []:
+            writer.add("children", U32.pack(subjects[id(child)]))
+        first_action = writer.count("actions")
+        for action in node.get('actions', None) or []:
+            writer.add("actions", ACTION.pack(
+                writer.string(action['name']), writer.string(action['state'])
+            ))
+        keywords = node.get('keywords', None)
+        if isinstance(keywords, list):
+            keywords = " ".join(keywords)
+        parent = node.get('parent', None)
+        writer.add("subjects", SUBJECT.pack(
+            NAME_LIST if isinstance(node['name'], list) else 0,
+            first_name, len(names),
+            writer.string(node.get('description', None)),
+            writer.string(node.get('url', None)),
+            writer.string(keywords),
+            subjects[id(parent)] if parent is not None else NONE,
+            first_child, len(node.get('children', None) or []),
+            first_action, len(node.get('actions', None) or []),
+        ))
+
+    documents: Dict[int, int] = {}
+    redirects = []
+    for source in sources.values():
+        first_document = writer.count("docs")
+        for document in source.documents:
+            documents[id(document)] = writer.add("docs", DOCUMENT.pack(
+                writer.string(document['key']), writer.string(document['name']),
+                subjects[id(document['node'])]
+            ))
+        redirects.append(source.redirects)
+        writer.add("sources", SOURCE.pack(
+            writer.string(str(source.filepath)), writer.string(source.prefix),
+            writer.string(source.digest), first_document, len(source.documents), 0, 0
+        ))
+    source_ids = {filepath: index for index, filepath in enumerate(sources)}
+    for index, paths in enumerate(redirects):
+        first_redirect = writer.count("redirect")
+        for subpath in paths:
+            writer.add("redirect", U32.pack(source_ids[subpath]))
+        record = list(SOURCE.unpack(writer.sections["sources"][index]))
+        record[5:7] = [first_redirect, len(paths)]
+        writer.sections["sources"][index] = SOURCE.pack(*record)
+
+    for document in docmap.values():
+        writer.add("docorder", U32.pack(documents[id(document)]))
+    for key in sorted(docmap):
+        writer.add("keyindex", U32.pack(documents[id(docmap[key])]))
+
+    for regex in regexes:
+        first_param = writer.count("params")
+        for param in regex.get('params', []):
+            if isinstance(param, int):
+                writer.add("params", PARAM.pack(PARAM_INT, param))
+            else:
+                writer.add("params", PARAM.pack(PARAM_STR, writer.string(str(param))))
+        writer.add("regexes", REGEX.pack(
+            writer.string(regex['regex']), writer.string(regex['state']),
+            first_param, len(regex.get('params', []))
+        ))
+
+    all_documents = [document for source in sources.values() for document in source.documents]
+    try:
+        compile_bm25(writer, all_documents, BACKENDS["bm25"])
+    except ImportError:
+        pass
+    compile_lunr(writer, all_documents, index_digest(sources), BACKENDS["lunr"])
+    writer.write(path)
+    return path
+
+
+def compile_bm25(writer: KnowledgeBaseWriter, documents: List[dict], backend) -> None:
+    """Adds the BM25 index of the documents of all sources to the knowledge base"""
+    # pylint: disable=import-outside-toplevel
+    import numpy as np
+    index = backend.build(documents)
+    for term in index.terms.tolist():
+        writer.add("bm25term", U32.pack(writer.string(term)))
+    writer.add("bm25", BM25_INDEX.pack(0, len(index.terms), 0, len(index.indices)))
+    for name, array, dtype in (
+        ("bm25ptr", index.indptr, np.int64),
+        ("bm25idx", index.indices, np.int32),
+        ("bm25wgt", index.weights, np.float32),
+    ):
+        writer.sections[name] = [array.astype(dtype).tobytes()]
+
+
+def compile_lunr(writer: KnowledgeBaseWriter, documents: List[dict], digest: str, backend) -> None:
+    """Adds the serialized lunr index of the documents of all sources to the knowledge base
+
+    Reuses the cached index of the same documents, if there is one.
+    """
+    index = backend.load(documents, digest)
+    writer.add("lunrver", U32.pack(writer.string(backend.version())))
+    writer.sections["lunr"] = [json.dumps(index.serialize()).encode('utf-8')]
+
+
+class KnowledgeBase:
+    """Memory-mapped reader of a knowledge base file"""
+    # pylint: disable=too-many-instance-attributes
+    checkpoint_shared = True
+
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path, 'rb') as kbfile:
+            self.buffer = mmap.mmap(kbfile.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC or version != KB_VERSION:
+            raise ValueError(f"Unsupported knowledge base {path}")
+        self.sections: Dict[str, Tuple[int, int]] = {}
+        for index in range(count):
+            name, offset, size = SECTION.unpack_from(
+                self.buffer, HEADER.size + index * SECTION.size
+            )
+            self.sections[name.rstrip(b"\0").decode('ascii')] = (offset, size)
+        self.string_offsets = self.sections["stroff"][0]
+        self.string_data = self.sections["strdat"][0]
+        self.decoded: Dict[int, str] = {}
+        self.nodes: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+        self.docmap = DocumentMap(self)
+
+    def string(self, index: int) -> str | None:
+        """Returns string by index"""
+        if index == NONE:
+            return None
+        value = self.decoded.get(index)
+        if value is None:
+            start, end = struct.unpack_from("<II", self.buffer, self.string_offsets + 4 * index)
+            value = self.decoded[index] = (
+                self.buffer[self.string_data + start:self.string_data + end].decode('utf-8')
+            )
+        return value
+
+    def count(self, record: struct.Struct, section: str) -> int:
+        """Returns the number of records in a section"""
+        return self.sections.get(section, (0, 0))[1] // record.size
+
+    def record(self, record: struct.Struct, section: str, index: int) -> tuple:
+        """Returns the fields of a record"""
+        return record.unpack_from(self.buffer, self.sections[section][0] + index * record.size)
+
+    def files(self) -> List[Tuple[str, str, int, float]]:
+        """Returns the path, content hash, kind, and mtime of the compiled files
+
+        The mtime is None if it could not be read when the file was compiled.
+        """
+        return [
+            (
+                self.string(path), self.string(digest), kind,
+                None if math.isnan(mtime) else mtime
+            )
+            for path, digest, kind, mtime in (
+                self.record(FILE, "files", index) for index in range(self.count(FILE, "files"))
+            )
+        ]
+
+    def fresh(self) -> bool:
+        """Checks if no compiled file changed
+
+        Files without a compiled mtime are compared by content hash.
+        """
+        for path, digest, _, mtime in self.files():
+            try:
+                if mtime is not None:
+                    if os.path.getmtime(path) != mtime:
+                        return False
+                elif hashlib.sha256(Path(path).read_bytes()).hexdigest() != digest:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def node(self, index: int) -> SubjectView:
+        """Returns view of a subject. Views of the same subject are shared while alive"""
+        view = self.nodes.get(index)
+        if view is None:
+            view = self.nodes[index] = SubjectView(self, index)
+        return view
+
+    def document(self, index: int) -> DocumentView:
+        """Returns view of a document"""
+        return DocumentView(self, index)
+
+    def sources(self) -> List[Tuple[str, str, str, DocumentList, List[str]]]:
+        """Returns the path, prefix, digest, documents, and redirects of each source"""
+        result = []
+        for index in range(self.count(SOURCE, "sources")):
+            path, prefix, digest, first_document, documents, first_redirect, redirects = (
+                self.record(SOURCE, "sources", index)
+            )
+            result.append((
+                self.string(path), self.string(prefix), self.string(digest),
+                DocumentList(self, first_document, documents),
+                [
+                    self.string(self.record(SOURCE, "sources", U32.unpack_from(
+                        self.buffer, self.sections["redirect"][0] + 4 * redirect
+                    )[0])[0])
+                    for redirect in range(first_redirect, first_redirect + redirects)
+                ],
+            ))
+        return result
+
+    def regexes(self) -> List[dict]:
+        """Returns regex definitions"""
+        result = []
+        for index in range(self.count(REGEX, "regexes")):
+            regex, state, first_param, params = self.record(REGEX, "regexes", index)
+            values: List[Any] = []
+            for param in range(first_param, first_param + params):
+                kind, value = self.record(PARAM, "params", param)
+                values.append(value if kind == PARAM_INT else self.string(value))
+            result.append({
+                'regex': self.string(regex), 'params': values, 'state': self.string(state)
+            })
+        return result
+
+    def index(self, name: str):
+        """Returns the compiled index of a search backend, or None if it is not compiled"""
+        if name == "bm25":
+            return self.bm25_index()
+        if name == "lunr":
+            return self.lunr_index()
+        return None
+
+    def lunr_index(self):
+        """Returns the lunr index of all sources, parsed from the knowledge base
+
+        Returns None if it was compiled by another lunr version.
+        """
+        # pylint: disable=import-outside-toplevel
+        from lunr.index import Index  # type: ignore
+        from .handlers.search import BACKENDS
+        if not self.count(U32, "lunrver"):
+            return None
+        version = self.string(U32.unpack_from(self.buffer, self.sections["lunrver"][0])[0])
+        if version != BACKENDS["lunr"].version():
+            return None
+        offset, size = self.sections["lunr"]
+        return Index.load(json.loads(self.buffer[offset:offset + size]))
+
+    def bm25_index(self):
+        """Returns the BM25 index of all sources without copying its arrays"""
+        # pylint: disable=import-outside-toplevel
+        import numpy as np
+        from .handlers.search import BM25Shard
+        if not self.count(BM25_INDEX, "bm25"):
+            return None
+        first_term, terms, first_posting, postings = self.record(BM25_INDEX, "bm25", 0)
+
+        def array(section, dtype, first, count):
+            return np.frombuffer(
+                self.buffer, dtype=dtype, count=count,
+                offset=self.sections[section][0] + first * np.dtype(dtype).itemsize
+            )
+        term_ids = array("bm25term", np.uint32, first_term, terms)
+        return BM25Shard(
+            [
+                document['key'] for _, _, _, documents, _ in self.sources()
+                for document in documents
+            ],
+            np.array([self.string(term) for term in term_ids.tolist()], dtype=str),
+            array("bm25ptr", np.int64, first_term, terms + 1),
+            array("bm25idx", np.int32, first_posting, postings),
+            array("bm25wgt", np.float32, first_posting, postings),
+        )
+
+
+class SubjectView(Mapping):
+    """Read-only subject backed by a knowledge base record
+
+    Supports the dict operations that handlers use on subjects.
+    """
+    __slots__ = ('kb', 'index', 'fields', '__weakref__')
+    checkpoint_shared = True
+
+    def __init__(self, kb: KnowledgeBase, index: int):
+        self.kb = kb
+        self.index = index
+        self.fields = kb.record(SUBJECT, "subjects", index)
+
+    def keys(self):
+        (_, _, _, description, url, keywords, parent,
+         _, children, _, actions) = self.fields
+        result = ['name']
+        for key, present in (
+            ('description', description != NONE), ('url', url != NONE),
+            ('keywords', keywords != NONE), ('parent', parent != NONE),
+            ('children', children > 0), ('actions', actions > 0),
+        ):
+            if present:
+                result.append(key)
+        return result
+
+    def __getitem__(self, key: str) -> Any:
+        (flags, first_name, names, description, url, keywords, parent,
+         first_child, children, first_action, actions) = self.fields
+        kb = self.kb
+        if key == 'name':
+            values = [
+                kb.string(kb.record(U32, "names", name)[0])
+                for name in range(first_name, first_name + names)
+            ]
+            return values if flags & NAME_LIST else values[0]
+        if key in ('description', 'url', 'keywords'):
+            value = {'description': description, 'url': url, 'keywords': keywords}[key]
+            if value != NONE:
+                return kb.string(value)
+        elif key == 'parent' and parent != NONE:
+            return kb.node(parent)
+        elif key == 'children' and children:
+            return [
+                kb.node(kb.record(U32, "children", child)[0])
+                for child in range(first_child, first_child + children)
+            ]
+        elif key == 'actions' and actions:
+            return [
+                {'name': kb.string(name), 'state': kb.string(state)}
+                for name, state in (
+                    kb.record(ACTION, "actions", action)
+                    for action in range(first_action, first_action + actions)
+                )
+            ]
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def __repr__(self) -> str:
+        return f"SubjectView({self['name']!r})"
+
+
+class DocumentView(Mapping):
+    """Read-only subject document backed by a knowledge base record"""
+    __slots__ = ('kb', 'index', 'fields')
+
+    def __init__(self, kb: KnowledgeBase, index: int):
+        self.kb = kb
+        self.index = index
+        self.fields = kb.record(DOCUMENT, "docs", index)
+
+    def __getitem__(self, key: str) -> Any:
+        key_id, name, subject = self.fields
+        if key == 'key':
+            return self.kb.string(key_id)
+        if key == 'name':
+            return self.kb.string(name)
+        if key == 'node':
+            return self.kb.node(subject)
+        if key in ('description', 'keywords'):
+            return self.kb.node(subject).get(key, '')
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(('key', 'name', 'description', 'keywords', 'node'))
+
+    def __len__(self) -> int:
+        return 5
+
+
+class DocumentList(Sequence):
+    """Read-only list of the documents of a source"""
+
+    def __init__(self, kb: KnowledgeBase, first: int, count: int):
+        self.kb = kb
+        self.first = first
+        self.count_ = count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("document index out of range")
+        return self.kb.document(self.first + index)
+
+    def __len__(self) -> int:
+        return self.count_
+
+
+class DocumentMap(Mapping):
+    """Read-only map from subject keys to documents
+
+    Iterates in the order the documents were loaded and finds keys by binary
+    search over the sorted key index.
+    """
+
+    def __init__(self, kb: KnowledgeBase):
+        self.kb = kb
+        self.size = kb.count(U32, "keyindex")
+        self.sorted_keys = _SortedKeys(self)
+
+    def document_id(self, section: str, position: int) -> int:
+        """Returns the document index stored at position of section"""
+        return self.kb.record(U32, section, position)[0]
+
+    def __getitem__(self, key: str) -> DocumentView:
+        position = bisect_left(self.sorted_keys, key)
+        if position < self.size:
+            document = self.kb.document(self.document_id("keyindex", position))
+            if document['key'] == key:
+                return document
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        for document in self.documents():
+            yield document['key']
+
+    def __len__(self) -> int:
+        return self.size
+
+    def documents(self) -> Iterator[DocumentView]:
+        """Iterates over documents in load order"""
+        for position in range(self.size):
+            yield self.kb.document(self.document_id("docorder", position))
+
+    def items(self):
+        return [(document['key'], document) for document in self.documents()]
+
+    def values(self):
+        return list(self.documents())
+
+
+class _SortedKeys(Sequence):
+    """Sorted keys of a document map, decoded on access for bisect"""
+
+    def __init__(self, docmap: DocumentMap):
+        self.docmap = docmap
+
+    def __getitem__(self, position):
+        kb = self.docmap.kb
+        return kb.document(self.docmap.document_id("keyindex", position))['key']
+
+    def __len__(self) -> int:
+        return self.docmap.size
+
+
+_SHARED: KnowledgeBase | None = None
+_SHARED_LOCK = threading.Lock()
+
+
+def knowledge_base() -> KnowledgeBase | None:
+    """Returns the shared knowledge base, compiling it if a data file changed
+
+    Returns None when NEWTONCHAT_KNOWLEDGE_BASE is 0 or the file cannot be
+    written or read, so handlers fall back to parsing the data files.
+    """
+    # pylint: disable=global-statement
+    global _SHARED
+    if os.environ.get("NEWTONCHAT_KNOWLEDGE_BASE", "1") == "0":
+        return None
+    with _SHARED_LOCK:
+        if _SHARED is not None and _SHARED.fresh():
+            return _SHARED
+        path = knowledge_path()
+        try:
+            kb = KnowledgeBase(path)
+            if kb.fresh():
+                _SHARED = kb
+                return kb
+        except (OSError, ValueError, KeyError, struct.error):
+            pass
+        try:
+            _SHARED = KnowledgeBase(compile_knowledge_base(path))
+        except (OSError, ValueError, KeyError, struct.error):
+            _SHARED = None
+        return _SHARED
+
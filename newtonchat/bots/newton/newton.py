@@ -5,7 +5,10 @@ from typing import TYPE_CHECKING
 import traceback
 
 from ...comm.message import MessageContext
+from ...shared_index import shared_index_client
+from .autocomplete import autocomplete_items
 from .handlers.regex import RegexHandler
+from .handlers.search import DEFAULT_BACKEND, available_backends, backend_name
 from .handlers.subject import SubjectHandler
 from .handlers.url import URLHandler
 from .resources import import_state_module
@@ -22,7 +25,7 @@ class DefaultState:
     """Default Newton state"""
 
     def __init__(self):
-        self.subject_handler = SubjectHandler()
+        self.subject_handler = SubjectHandler(shared_index_client())
 
         self.solvers = [
             RegexHandler(),
@@ -42,19 +45,10 @@ class DefaultState:
 
     def process_autocomplete(self, instance: ChatInstance, request_id: int, query: str):
         """Processes subject queries"""
-        result = []
-        for match, node in self.subject_handler.search(query):
-            result.append({
-                'type': 'subject',
-                'key': match['ref'],
-                'value': node.get('description', ''),
-                'url': node.get('url', ''),
-            })
-        result = result[:5]
         instance.send({
             "operation": "autocomplete-response",
             "responseId": request_id,
-            "items": result,
+            "items": autocomplete_items(self.subject_handler.complete(query, 5)),
         })
 
 
@@ -68,11 +62,13 @@ class NewtonBot:
     @classmethod
     def config(cls):
         """Defines configuration inputs for bot"""
-        return {}
-    
+        return {
+            "search_backend": ('datalist', {"value": DEFAULT_BACKEND, "options": available_backends()}),
+        }
+
     def start(self, instance: ChatInstance, data: dict):
         """Initializes bot"""
-        # pylint: disable=unused-argument
+        instance.config["search_backend"] = backend_name(data.get("search_backend"))
         instance.history.append(MessageContext.create_message(
             ("Hello, I am Newton, an assistant that can help you with machine learning. "
              "You can ask me questions at any given time and go back to previous questions too. "
@@ -165,6 +161,7 @@ class NewtonBot:
                 self.set_state(context, check_state)
                 return
             elif reply and len(history) >= 2 and reply != history[-2]['id']:
+                # Reply to an older message without checkpoint, possibly evicted
                 self.set_state(context, self.default_state)
 
         try:
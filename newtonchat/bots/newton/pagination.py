@@ -7,64 +7,75 @@ from .states.utils import statemanager
 
 
 if TYPE_CHECKING:
-    from typing import List, Tuple
+    from typing import Any, Callable, List, Optional, Sequence
     from ...comm.message import MessageContext
     from .action import StatefulOption
     from .states.state import StateCallable
 
 
-def create_page(page: int, count: int, items: List[StatefulOption], last: bool) -> StateCallable:
-    """Creates page state"""
+def create_page(
+    items: Sequence[Any],
+    offset: int,
+    count: int,
+    create_order: bool,
+    build: Optional[Callable[[Any], StatefulOption]]
+) -> StateCallable:
+    """Creates page state. It only builds the page options when the page is shown"""
     @statemanager()
     def more_state(context: MessageContext):
-        start_pos = (page - 1)*count + 1
-        end_pos = start_pos + count - 1
-        if last:
-            end_pos = start_pos + len(items)
-        show_options(
-            context, items, ordered=False,
-            text=f"Showing {start_pos}..{end_pos} (page {page})"
-        )
+        show_page(context, items, offset, count, create_order, build)
     return more_state
 
 
-def _pagination(
-    options: List[StatefulOption],
-    count: int=5,
-    page: int=1
-) -> Tuple[List[StatefulOption], bool]:
-    """Splits options into pages"""
-    if len(options) <= count + 1:
-        return options, True
-    current, extra = options[:count], options[count:]
-    next_page = page + 1
-    current.append({
-        'key': f"<page {next_page}>",
-        'label': "More...",
-        'state': create_page(
-            next_page, count, *_pagination(extra, count, page=next_page)
-        )
-    })
-    return current, False
+def show_page(
+    context: MessageContext,
+    items: Sequence[Any],
+    offset: int,
+    count: int,
+    create_order: bool,
+    build: Optional[Callable[[Any], StatefulOption]],
+    text: str | None = None
+) -> None:
+    """Shows the page of items that starts at offset"""
+    # pylint: disable=too-many-arguments
+    end = len(items) if len(items) - offset <= count + 1 else offset + count
+    options: List[StatefulOption] = []
+    for num in range(offset, end):
+        item = items[num]
+        option = build(item) if build else item
+        if create_order:
+            option = {
+                'key': option['key'],
+                'label': f'{num + 1}. {option["label"]}',
+                'state': option['state']
+            }
+        options.append(option)
+
+    page = offset // count + 1
+    if end < len(items):
+        options.append({
+            'key': f"<page {page + 1}>",
+            'label': "More...",
+            'state': create_page(items, end, count, create_order, build)
+        })
+    if end < len(items) or offset > 0:
+        text = text + "\n" if text else ""
+        text += f"Showing {offset + 1}..{end} (page {page})"
+    show_options(context, options, ordered=False, text=text)
 
 
 def pagination(
     context: MessageContext,
-    items: List[StatefulOption],
+    items: Sequence[Any],
     *,
     count: int=5,
     create_order: bool=True,
-    text: str | None = None
+    text: str | None = None,
+    build: Optional[Callable[[Any], StatefulOption]] = None
 ):
-    """Paginates options and shows first page for consistency"""
-    if create_order:
-        items = [{
-            'key': item['key'],
-            'label': f'{num + 1}. {item["label"]}',
-            'state': item['state']
-        } for num, item in enumerate(items)]
-    items, last = _pagination(items, count=count)
-    if not last:
-        text = text + "\n" if text else ""
-        text += f"Showing 1..{count} (page 1)"
-    show_options(context, items, ordered=False, text=text)
+    """Paginates options and shows first page for consistency
+
+    Pages share the items sequence. If build is given, items are converted
+    into options only when their page is shown.
+    """
+    show_page(context, items, 0, count, create_order, build, text=text)
@@ -0,0 +1,132 @@
+"""Defines cache for completion responses"""
+from __future__ import annotations
+
+from collections import OrderedDict
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from .storage import cache
+
+
+class ResponseCache:
+    """Two-tier cache for completion responses
+
+    The memory tier is a LRU with at most memory_size entries. The disk tier
+    is a SQLite database with at most disk_size entries, evicted by last
+    access. Entries older than ttl seconds are ignored and removed.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, path=None, memory_size=128, disk_size=10000, ttl=7 * 24 * 60 * 60):
+        self.path = path or cache() / "responses.sqlite3"
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.ttl = ttl
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.connection = None
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+
+    @staticmethod
+    def key(prompt: str, model_config: dict, api_base: str = "") -> str:
+        """Returns cache key for prompt, model config, and API base URL"""
+        content = json.dumps(
+            {"prompt": prompt, "config": model_config, "api_base": api_base}, sort_keys=True
+        )
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def connect(self):
+        """Returns SQLite connection, creating the database on first use"""
+        if self.connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, text TEXT, created REAL, accessed REAL)"
+            )
+            self.connection.commit()
+        return self.connection
+
+    def get(self, key: str) -> str | None:
+        """Returns cached response or None"""
+        now = time.time()
+        with self.lock:
+            if key in self.memory:
+                text, created = self.memory[key]
+                if now - created < self.ttl:
+                    self.memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return text
+                del self.memory[key]
+            try:
+                connection = self.connect()
+                row = connection.execute(
+                    "SELECT text, created FROM responses WHERE key = ? AND created > ?",
+                    (key, now - self.ttl)
+                ).fetchone()
+                if row is not None:
+                    connection.execute(
+                        "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+                    )
+                    connection.commit()
+            except (OSError, sqlite3.Error):
+                row = None
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+            self.counters["disk_hits"] += 1
+            self._remember(key, row[0], row[1])
+            return row[0]
+
+    def set(self, key: str, text: str) -> None:
+        """Stores response in both tiers"""
+        now = time.time()
+        with self.lock:
+            self.counters["stores"] += 1
+            self._remember(key, text, now)
+            try:
+                connection = self.connect()
+                connection.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, text, now, now)
+                )
+                connection.execute("DELETE FROM responses WHERE created <= ?", (now - self.ttl,))
+                connection.execute(
+                    "DELETE FROM responses WHERE key NOT IN "
+                    "(SELECT key FROM responses ORDER BY accessed DESC LIMIT ?)",
+                    (self.disk_size,)
+                )
+                connection.commit()
+            except (OSError, sqlite3.Error):
+                pass
+
+    def _remember(self, key: str, text: str, created: float) -> None:
+        """Stores response in memory tier. Must be called with the lock"""
+        self.memory[key] = (text, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def stats(self) -> dict:
+        """Returns hit and miss counters"""
+        with self.lock:
+            result = dict(self.counters)
+            result["memory_entries"] = len(self.memory)
+        result["hits"] = result["memory_hits"] + result["disk_hits"]
+        return result
+
+
+_SHARED = None
+_SHARED_LOCK = threading.Lock()
+
+
+def shared_cache() -> ResponseCache:
+    """Returns response cache shared by all bots of the kernel"""
+    # pylint: disable=global-statement
+    global _SHARED
+    with _SHARED_LOCK:
+        if _SHARED is None:
+            _SHARED = ResponseCache()
+        return _SHARED
@@ -0,0 +1,11 @@
+"""Handle paths for data derived at runtime"""
+import os
+from pathlib import Path
+
+
+def cache():
+    """Returns cache path for derived data. Override it with NEWTONCHAT_CACHE"""
+    path = os.environ.get("NEWTONCHAT_CACHE")
+    if path:
+        return Path(path)
+    return Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "newtonchat"
@@ -0,0 +1,76 @@
+"""Defines coalescing dispatcher for autocomplete queries"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+import threading
+import traceback
+import weakref
+
+if TYPE_CHECKING:
+    from typing import Callable
+
+
+# Seconds an idle dispatcher thread waits for queries before exiting
+IDLE_TIMEOUT = 30
+
+
+class AutocompleteDispatcher:
+    """Processes the autocomplete queries of a chat instance in a background thread
+
+    Only the latest pending query is kept. Queries that arrive while another
+    one is being processed replace each other, so stale queries of fast
+    typists are dropped instead of being answered one by one.
+    """
+
+    def __init__(self, process: Callable[[int, str], None]):
+        self.process = weakref.WeakMethod(process)
+        self.pending: tuple[int, str] | None = None
+        self.thread: threading.Thread | None = None
+        self.condition = threading.Condition()
+        self.counters = {"received": 0, "processed": 0, "coalesced": 0}
+
+    def submit(self, request_id: int, query: str) -> None:
+        """Schedules query, replacing the pending one"""
+        with self.condition:
+            self.counters["received"] += 1
+            if self.pending is not None:
+                self.counters["coalesced"] += 1
+            self.pending = (request_id, query)
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="newtonchat-autocomplete", daemon=True
+                )
+                self.thread.start()
+            self.condition.notify()
+
+    def superseded(self) -> bool:
+        """Checks if a newer query is waiting"""
+        with self.condition:
+            return self.pending is not None
+
+    def run(self) -> None:
+        """Processes pending queries until the dispatcher is idle"""
+        while True:
+            with self.condition:
+                if self.pending is None:
+                    self.condition.wait(IDLE_TIMEOUT)
+                if self.pending is None:
+                    self.thread = None
+                    return
+                request_id, query = self.pending
+                self.pending = None
+            process = self.process()
+            if process is None:
+                return
+            try:
+                process(request_id, query)
+            except Exception:  # pylint: disable=broad-except
+                print(traceback.format_exc())
+            with self.condition:
+                self.counters["processed"] += 1
+            del process
+
+    def stats(self) -> dict:
+        """Returns query counters"""
+        with self.condition:
+            return dict(self.counters)
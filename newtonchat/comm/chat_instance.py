@@ -1,10 +1,16 @@
 """Define a chat instance"""
 from __future__ import annotations
 from collections import defaultdict
+import os
+import threading
 import traceback
+import uuid
 import weakref
 from typing import TYPE_CHECKING
 from ..loader import LOADERS
+from .autocomplete import AutocompleteDispatcher
+from .checkpoints import CheckpointRegistry
+from .history import create_history_store
 from .message import KernelProcess, MessageContext
 
 if TYPE_CHECKING:
@@ -12,6 +18,13 @@ if TYPE_CHECKING:
     from .message import IChatMessage
 
 
+# Maximum number of messages sent when the client does not have the history
+HISTORY_WINDOW = 100
+# Maximum number of changed messages whose revision is kept. Clients that
+# synced before the oldest kept revision receive the whole window again
+REVISION_LIMIT = int(os.environ.get("NEWTONCHAT_REVISION_LIMIT", 1000))
+
+
 def apply_partial(original: dict, update: dict):
     """Apply nested changes to original dict"""
     for key, value in update.items():
@@ -31,9 +44,23 @@ class ChatInstance:
         self.memory = defaultdict(lambda: None)
 
         self.chat_name = chat_name
+        # Replaced or removed instances stop sending, so their late replies
+        # do not reach a new instance with the same name
+        self.retired = False
 
-        self.history = []
-        self.message_map = {}
+        # History is append-only. The sequence number of a message is its
+        # position in the history plus one. The epoch changes whenever the
+        # history is replaced, invalidating sequence numbers known by clients
+        self.history = create_history_store(self.evict_message)
+        self.history_epoch = str(uuid.uuid4())
+        # The revision increases whenever a message in the history changes.
+        # Clients send the revision of their last sync to receive the
+        # messages that changed after it. Only the last REVISION_LIMIT
+        # changed messages are kept. Changes up to revision_floor are dropped
+        self.revision = 0
+        self.revisions: dict[str, int] = {}
+        self.revision_floor = 0
+        self.revision_lock = threading.Lock()
         self.config = {
             "process_in_kernel": True,
             "enable_autocomplete": True,
@@ -49,7 +76,8 @@ class ChatInstance:
             "show_metadata": False,
             "direct_send_to_user": False,
         }
-        self.checkpoints = {}
+        self.checkpoints = CheckpointRegistry()
+        self.autocomplete = AutocompleteDispatcher(self.process_autocomplete_query)
 
     @property
     def bot(self):
@@ -57,24 +85,86 @@ class ChatInstance:
         return self.bot_loader.current()
 
     def start_bot(self, data: dict):
-        """Starts bot and sets history map"""
+        """Starts bot"""
         self.bot.start(self, data)
-        for message in self.history:
-            self.message_map[message['id']] = message
         return self
 
-    def sync_chat(self, operation):
-        """Sends message with history and general config"""
+    def evict_message(self, message: IChatMessage):
+        """Drops checkpoint of message evicted from memory"""
+        self.checkpoints.pop(message['id'], None)
+
+    def sync_chat(self, operation, since=0, epoch=None, revision=None):
+        """Sends message with general config and the history after sequence number since
+
+        Sends only the last HISTORY_WINDOW messages if epoch does not match the
+        current history epoch or if there are too many messages after since.
+        Clients request older messages with history-page.
+
+        If the epoch matches and the client sends the revision of its last
+        sync, messages before since that changed after that revision, such
+        as replies that were still loading, are sent in updated. If the
+        changes after that revision were dropped, updated is None and the
+        client replaces its messages with the last HISTORY_WINDOW messages
+        """
+        # Read before the history, so changes made meanwhile are sent again
+        current_revision = self.revision
+        total = len(self.history)
+        updated: list | None = []
+        if revision is not None and revision < self.revision_floor:
+            updated = None
+        if (
+            epoch != self.history_epoch or updated is None
+            or not 0 <= since <= total or total - since > HISTORY_WINDOW
+        ):
+            since = max(total - HISTORY_WINDOW, 0)
+        history = self.history[since:]
+        if updated is not None and epoch == self.history_epoch and revision is not None:
+            updated = self.updated_messages(revision, {message['id'] for message in history})
         self.send({
             "operation": operation,
-            "history": self.history,
+            "history": history,
+            "since": since,
+            "total": len(self.history),
+            "epoch": self.history_epoch,
+            "revision": current_revision,
+            "updated": updated,
             "config": self.config,
         })
 
-    def refresh(self):
+    def updated_messages(self, revision, exclude):
+        """Returns the messages that changed after revision, except the ids in exclude
+
+        Changed messages that were spilled are read from disk, one read per
+        message, so a sync reads at most REVISION_LIMIT messages.
+        """
+        result = []
+        with self.revision_lock:
+            # Revisions are kept in increasing order
+            revisions = list(self.revisions.items())
+        for message_id, message_revision in reversed(revisions):
+            if message_revision <= revision:
+                break
+            if message_id not in exclude and (message := self.history.find(message_id)):
+                result.append(message)
+        result.reverse()
+        return result
+
+    def send_history_page(self, before, count=HISTORY_WINDOW):
+        """Sends up to count messages before sequence number before"""
+        before = min(max(before, 0), len(self.history))
+        start = max(before - max(count, 0), 0)
+        self.send({
+            "operation": "history-page",
+            "history": self.history[start:before],
+            "since": start,
+            "total": len(self.history),
+            "epoch": self.history_epoch,
+        })
+
+    def refresh(self, since=0, epoch=None, revision=None):
         """Refreshes instance"""
         self.bot.refresh(self)
-        self.sync_chat("refresh")
+        self.sync_chat("refresh", since, epoch, revision)
 
     def receive(self, data: dict):
         """Processes received requests"""
@@ -84,6 +174,10 @@ class ChatInstance:
                 self.receive_message(data.get("message"))
             elif operation == "refresh":
                 self.refresh()
+            elif operation == "sync-since":
+                self.refresh(data.get("since", 0), data.get("epoch"), data.get("revision"))
+            elif operation == "history-page":
+                self.send_history_page(data["before"], data.get("count", HISTORY_WINDOW))
             elif operation == "autocomplete-query":
                 self.receive_autocomplete_query(
                     data.get('requestId'),
@@ -100,12 +194,12 @@ class ChatInstance:
                 })
             elif operation == "sync-message":
                 partial_message = data["message"]
-                message = self.message_map[partial_message["id"]]
+                message = self.history.find(partial_message["id"])
+                if message is None:
+                    raise KeyError(f"Message {partial_message['id']} not found")
                 apply_partial(message, partial_message)
-                self.send({
-                    "operation": "update-message",
-                    "message": message,
-                })
+                self.history.update(message)
+                self.update_message(message)
         except Exception:  # pylint: disable=broad-except
             print(traceback.format_exc())
             self.send({
@@ -117,11 +211,12 @@ class ChatInstance:
     def receive_message(self, message: IChatMessage):
         """Receives message from user"""
         self.history.append(message)
-        self.message_map[message['id']] = message
         self.send({
             "operation": "reply",
             "message": message
         })
+        # The echo must not wait in the batch until the bot replies
+        self.comm_ref().flush()
         process_message = (
             message.get('kernelProcess') == KernelProcess.PROCESS
             and self.config["process_in_kernel"]
@@ -140,15 +235,18 @@ class ChatInstance:
             )
         )
         if replicate_other_instances:
-            for chat_name, instance in self.comm_ref().chat_instances.items():
-                if chat_name != "base" and instance.config["process_base_chat_message"]:
-                    instance.receive_message(message)
+            comm = self.comm_ref()
+            comm.scheduler.fan_out([
+                (instance, instance.receive_message, (message,))
+                for chat_name, instance in list(comm.chat_instances.items())
+                if chat_name != "base" and instance.config["process_base_chat_message"]
+            ])
 
 
     def receive_autocomplete_query(self, request_id, query):
-        """Receives query from user"""
+        """Receives query from user and schedules it, dropping older pending queries"""
         if self.config["enable_autocomplete"]:
-            self.bot.process_autocomplete(self, request_id, query)
+            self.autocomplete.submit(request_id, query)
         else:
             self.send({
                 "operation": "autocomplete-response",
@@ -156,27 +254,73 @@ class ChatInstance:
                 "items": [],
             })
 
+    def process_autocomplete_query(self, request_id, query):
+        """Processes scheduled autocomplete query, holding the bot lock of the scheduler
+
+        The lock keeps requests that reload bot state, such as subject
+        files, from running while the query reads it.
+        """
+        try:
+            bot = self.bot
+            with self.comm_ref().scheduler.bot_lock(bot):
+                bot.process_autocomplete(self, request_id, query)
+        except Exception:  # pylint: disable=broad-except
+            print(traceback.format_exc())
+            self.send({
+                "operation": "error",
+                "command": "autocomplete-query",
+                "message": traceback.format_exc(),
+            })
+
     def send(self, data):
         """Receives send results"""
+        if self.retired:
+            return
         data["instance"] = self.chat_name
-        self.comm_ref().comm.send(data)
+        self.comm_ref().send(data)
 
     def reply_message(self, message: IChatMessage):
         """Replies IChatMessage to user"""
         self.history.append(message)
-        self.message_map[message['id']] = message
         self.send({
             "operation": "reply",
             "message": message
         })
 
+    def update_message(self, message: IChatMessage):
+        """Sends updated IChatMessage to user"""
+        with self.revision_lock:
+            self.revision += 1
+            self.revisions.pop(message['id'], None)
+            self.revisions[message['id']] = self.revision
+            if len(self.revisions) > REVISION_LIMIT:
+                oldest = next(iter(self.revisions))
+                self.revision_floor = self.revisions.pop(oldest)
+        self.send({
+            "operation": "update-message",
+            "message": message
+        })
+
+    def stats(self):
+        """Returns instance statistics"""
+        result = {
+            "messages": len(self.history),
+            "checkpoints": self.checkpoints.stats(),
+            "history": self.history.stats(),
+            "autocomplete": self.autocomplete.stats(),
+            "queue": self.comm_ref().scheduler.stats(self.chat_name),
+        }
+        if hasattr(self.bot, "stats"):
+            result["bot"] = self.bot.stats()
+        return result
+
     def save(self):
         """Saves instance data"""
         return {
             "name": self.chat_name,
             "mode": self.mode,
             "bot": self.bot.save(),
-            "history": self.history,
+            "history": list(self.history),
             "config": self.config
         }
 
@@ -187,8 +331,8 @@ class ChatInstance:
         if "bot" in data:
             self.bot.load(data["bot"])
         if "history" in data:
-            self.history = data["history"]
-            self.message_map = {}
-            for message in self.history:
-                self.message_map[message['id']] = message
+            self.history = create_history_store(self.evict_message, data["history"])
+            self.history_epoch = str(uuid.uuid4())
+            self.revisions = {}
+            self.revision_floor = 0
         self.config = {**self.config, **data.get("config", {})}
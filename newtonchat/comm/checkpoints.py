@@ -0,0 +1,134 @@
+"""Defines bounded registry of checkpoints"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from collections import OrderedDict
+import os
+import sys
+import threading
+import types
+import weakref
+
+if TYPE_CHECKING:
+    from ..bots.newton.states.state import StateDefinition
+
+
+def is_shared(obj) -> bool:
+    """Checks if obj belongs to a bot or handler rather than to a checkpoint
+
+    Classes set checkpoint_shared = True when their objects are shared by
+    all checkpoints, such as the subject graph. Freeing a checkpoint does
+    not free them, so they are not charged to it.
+    """
+    return (
+        isinstance(obj, (type, types.ModuleType))
+        or getattr(type(obj), "checkpoint_shared", False)
+    )
+
+
+def estimate_size(obj, limit: int = 2000) -> int:
+    """Estimates the memory retained by a checkpoint, visiting at most limit objects"""
+    size = 0
+    seen = set()
+    visit = [obj]
+    while visit and len(seen) < limit:
+        current = visit.pop()
+        if id(current) in seen or is_shared(current):
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        if isinstance(current, dict):
+            visit.extend(current.keys())
+            visit.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            visit.extend(current)
+        elif isinstance(current, types.FunctionType):
+            visit.extend(cell.cell_contents for cell in current.__closure__ or ()
+                         if cell.cell_contents is not None)
+            if hasattr(current, "__wrapped__"):
+                visit.append(current.__wrapped__)
+        elif hasattr(current, "__dict__"):
+            visit.append(current.__dict__)
+    return size
+
+
+class CheckpointRegistry:
+    """Maps message ids to checkpoints, evicting the least recently used ones
+
+    Evicts checkpoints when there are more than max_count checkpoints or when
+    their estimated size exceeds max_bytes. The last inserted checkpoint is
+    never evicted, even if it exceeds max_bytes on its own. Evicted
+    checkpoints are kept as weak references, so they can still be used while
+    something else, such as the current bot state, holds them.
+    """
+
+    def __init__(self, max_count: int | None = None, max_bytes: int | None = None):
+        if max_count is None:
+            max_count = int(os.environ.get("NEWTONCHAT_CHECKPOINT_COUNT", 1000))
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("NEWTONCHAT_CHECKPOINT_BYTES", 32 * 1024 * 1024))
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, tuple[StateDefinition, int]] = OrderedDict()
+        self.evicted = weakref.WeakValueDictionary()
+        self.total_bytes = 0
+        self.lock = threading.RLock()
+        self.counters = {"hits": 0, "weak_hits": 0, "misses": 0, "evictions": 0}
+
+    def __setitem__(self, key: str, checkpoint: StateDefinition) -> None:
+        with self.lock:
+            self.pop(key, None)
+            size = estimate_size(checkpoint)
+            self.entries[key] = (checkpoint, size)
+            self.total_bytes += size
+            while len(self.entries) > 1 and (
+                len(self.entries) > self.max_count or self.total_bytes > self.max_bytes
+            ):
+                old_key, (old_checkpoint, old_size) = self.entries.popitem(last=False)
+                self.total_bytes -= old_size
+                self.counters["evictions"] += 1
+                try:
+                    self.evicted[old_key] = old_checkpoint
+                except TypeError:
+                    pass
+
+    def get(self, key: str, default=None) -> StateDefinition:
+        """Returns checkpoint and marks it as recently used"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return self.entries[key][0]
+            if key and (checkpoint := self.evicted.get(key)) is not None:
+                self.counters["weak_hits"] += 1
+                del self.evicted[key]
+                self[key] = checkpoint
+                return checkpoint
+            if key:
+                self.counters["misses"] += 1
+            return default
+
+    def pop(self, key: str, default=None) -> StateDefinition:
+        """Removes checkpoint"""
+        with self.lock:
+            self.evicted.pop(key, None)
+            if key not in self.entries:
+                return default
+            checkpoint, size = self.entries.pop(key)
+            self.total_bytes -= size
+            return checkpoint
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stats(self) -> dict:
+        """Returns registry size and hit counters"""
+        with self.lock:
+            return {
+                **self.counters,
+                "count": len(self.entries),
+                "estimated_bytes": self.total_bytes,
+            }
@@ -0,0 +1,213 @@
+"""Defines chat history stores"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import weakref
+
+from ..bots.storage import cache
+from .message import ChatMessage
+from .serialization import to_wire
+
+if TYPE_CHECKING:
+    from typing import Callable, Iterable, Iterator
+    from .message import IChatMessage
+
+
+def deep_sizeof(obj) -> int:
+    """Estimates the memory used by a json-like object"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, ChatMessage):
+        size += sum(deep_sizeof(getattr(obj, name)) for name in ChatMessage.__slots__)
+    elif isinstance(obj, dict):
+        size += sum(deep_sizeof(key) + deep_sizeof(value) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_sizeof(item) for item in obj)
+    return size
+
+
+class HistoryStore:
+    """Keeps the whole chat history in memory
+
+    Supports the list operations used on ChatInstance.history: append, len,
+    indexing, slicing, and iteration.
+    """
+
+    def __init__(self, messages: Iterable[IChatMessage] | None = None):
+        self.messages: list[IChatMessage] = []
+        self.message_map: dict[str, IChatMessage] = {}
+        for message in messages or []:
+            self.append(message)
+
+    def append(self, message: IChatMessage) -> None:
+        """Appends message to history"""
+        self.messages.append(message)
+        self.message_map[message['id']] = message
+
+    def find(self, message_id: str) -> IChatMessage | None:
+        """Returns message by id"""
+        return self.message_map.get(message_id)
+
+    def update(self, message: IChatMessage) -> None:
+        """Persists changes of a message returned by find"""
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+    def __iter__(self) -> Iterator[IChatMessage]:
+        return iter(self.messages)
+
+    def stats(self) -> dict:
+        """Returns history size and memory usage"""
+        return {
+            "messages": len(self),
+            "in_memory": len(self.messages),
+            "memory_bytes": deep_sizeof(self.messages),
+            "disk_bytes": 0,
+        }
+
+
+class SpillHistoryStore(HistoryStore):
+    """Keeps the last window messages in memory and spills older ones to disk
+
+    Spilled messages are written to an append-only JSONL log in the cache
+    directory. Updates to spilled messages append a new record, and the
+    latest record of each message wins. The log is removed when the store is
+    garbage collected.
+    """
+
+    def __init__(
+        self,
+        window: int,
+        on_evict: Callable[[IChatMessage], None] | None = None,
+        messages: Iterable[IChatMessage] | None = None
+    ):
+        self.window = window
+        self.on_evict = on_evict
+        self.offset = 0
+        self.positions: dict[int, int] = {}
+        self.spilled_ids: dict[str, int] = {}
+        self.file = None
+        self.lock = threading.RLock()
+        super().__init__(messages)
+
+    def open_log(self):
+        """Returns log file, creating it on first use"""
+        if self.file is None:
+            directory = cache() / "history"
+            directory.mkdir(parents=True, exist_ok=True)
+            handle, path = tempfile.mkstemp(suffix=".jsonl", dir=directory)
+            self.file = os.fdopen(handle, "a+b")
+            weakref.finalize(self, _remove_log, self.file, path)
+        return self.file
+
+    def append(self, message: IChatMessage) -> None:
+        """Appends message to history and spills messages outside the window"""
+        with self.lock:
+            super().append(message)
+            if len(self.messages) > self.window:
+                self.spill(len(self.messages) - self.window)
+
+    def spill(self, count: int) -> None:
+        """Moves the oldest count messages in memory to disk"""
+        evicted = self.messages[:count]
+        for message in evicted:
+            self.write(self.offset, message)
+            self.spilled_ids[message['id']] = self.offset
+            self.message_map.pop(message['id'], None)
+            self.offset += 1
+        del self.messages[:count]
+        self.file.flush()
+        if self.on_evict is not None:
+            for message in evicted:
+                self.on_evict(message)
+
+    def write(self, index: int, message: IChatMessage) -> None:
+        """Appends a record of a message to the log"""
+        log = self.open_log()
+        log.seek(0, os.SEEK_END)
+        self.positions[index] = log.tell()
+        record = {"index": index, "message": to_wire(message)}
+        log.write(json.dumps(record).encode('utf-8') + b"\n")
+
+    def read(self, index: int) -> IChatMessage:
+        """Reads the latest record of a spilled message"""
+        with self.lock:
+            self.file.flush()
+            self.file.seek(self.positions[index])
+            return json.loads(self.file.readline())["message"]
+
+    def find(self, message_id: str) -> IChatMessage | None:
+        """Returns message by id, reading it from disk if it was spilled"""
+        if (message := self.message_map.get(message_id)) is not None:
+            return message
+        if (index := self.spilled_ids.get(message_id)) is not None:
+            return self.read(index)
+        return None
+
+    def update(self, message: IChatMessage) -> None:
+        """Persists changes of a spilled message"""
+        with self.lock:
+            if (index := self.spilled_ids.get(message['id'])) is not None:
+                self.write(index, message)
+                self.file.flush()
+
+    def __len__(self) -> int:
+        return self.offset + len(self.messages)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1 and start >= self.offset:
+                return self.messages[start - self.offset:max(stop - self.offset, 0)]
+            return [self[position] for position in range(start, stop, step)]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("history index out of range")
+        if index >= self.offset:
+            return self.messages[index - self.offset]
+        return self.read(index)
+
+    def __iter__(self) -> Iterator[IChatMessage]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def stats(self) -> dict:
+        """Returns history size and memory usage"""
+        result = super().stats()
+        result["spilled"] = self.offset
+        if self.file is not None:
+            with self.lock:
+                result["disk_bytes"] = self.file.seek(0, os.SEEK_END)
+        return result
+
+
+def _remove_log(file, path):
+    """Closes and removes history log"""
+    file.close()
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def create_history_store(
+    on_evict: Callable[[IChatMessage], None] | None = None,
+    messages: Iterable[IChatMessage] | None = None
+) -> HistoryStore:
+    """Creates history store. NEWTONCHAT_HISTORY_MEMORY sets the in-memory window
+
+    A window of 0 keeps the whole history in memory.
+    """
+    window = int(os.environ.get("NEWTONCHAT_HISTORY_MEMORY", 1000))
+    if window <= 0:
+        return HistoryStore(messages)
+    return SpillHistoryStore(window, on_evict, messages)
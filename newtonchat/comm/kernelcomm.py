@@ -1,12 +1,48 @@
 """Define a Comm for the bot"""
 from __future__ import annotations
 
+from contextlib import contextmanager
+import os
+import threading
 import traceback
 from ipykernel.comm import Comm
 
 from ..loader import LOADERS
 from .chat_instance import ChatInstance
 from .message import MessageContext
+from .scheduler import META_LANE, RETIRE_TIMEOUT, InstanceScheduler
+from .serialization import encode_payload, orjson, to_wire
+
+
+# Coalesce the operations sent while processing a request into one batch message
+BATCH = os.environ.get("NEWTONCHAT_COMM_BATCH", "1") != "0"
+# Encode large payloads with orjson and send them as a buffer. Small frequent
+# operations, such as streamed update-message, stay on the session encoder
+FAST_JSON = os.environ.get("NEWTONCHAT_FAST_JSON", "1" if orjson else "0") != "0"
+FAST_JSON_OPERATIONS = {"init", "refresh", "history-page", "instances", "batch"}
+
+
+def coalesce_operations(operations):
+    """Drops update-message operations superseded by another operation of the same message
+
+    Operations are serialized only when the batch is sent, so the reply or
+    the last update of a message already carries its latest content.
+    """
+    def message_key(data):
+        return (data.get("instance"), data["message"].get("id"))
+
+    replied = {message_key(data) for data in operations if data.get("operation") == "reply"}
+    result = []
+    seen = set()
+    for data in reversed(operations):
+        if data.get("operation") == "update-message":
+            key = message_key(data)
+            if key in seen or key in replied:
+                continue
+            seen.add(key)
+        result.append(data)
+    result.reverse()
+    return result
 
 
 class KernelComm:
@@ -16,6 +52,9 @@ class KernelComm:
         self.shell = shell
         self.name = "newton.comm"
         self.comm = None
+        self.send_lock = threading.Lock()
+        self.local = threading.local()
+        self.scheduler = InstanceScheduler(self.batch)
 
         self.chat_instances = {
             "base": ChatInstance(self, "base", mode).start_bot({})
@@ -30,9 +69,79 @@ class KernelComm:
         for instance in self.chat_instances.values():
             instance.sync_chat("init")
 
+    def send(self, data):
+        """Sends data to client, or adds it to the batch of the current thread"""
+        outbox = getattr(self.local, "outbox", None)
+        if outbox is not None:
+            outbox.append(data)
+            return
+        self.transmit(data)
+
+    def transmit(self, data):
+        """Sends data through the comm. Worker threads send concurrently, so sends are serialized
+
+        ChatMessage objects are converted to wire dicts here, so batched
+        operations carry the latest content of their messages. Large payloads
+        are sent as a JSON buffer when they can be encoded by the fast
+        encoder, avoiding the session encoder.
+        """
+        data = to_wire(data)
+        buffers = None
+        if FAST_JSON and data.get("operation") in FAST_JSON_OPERATIONS:
+            try:
+                buffers = [encode_payload(data)]
+                data = {
+                    "operation": data["operation"],
+                    "instance": data.get("instance"),
+                    "encoding": "json-buffer",
+                }
+            except (TypeError, ValueError):
+                buffers = None
+        with self.send_lock:
+            if buffers is None:
+                self.comm.send(data)
+            else:
+                self.comm.send(data, buffers=buffers)
+
+    @contextmanager
+    def batch(self):
+        """Collects the operations sent by the current thread and sends them together
+
+        Nested batches join the outer one.
+        """
+        if not BATCH or getattr(self.local, "outbox", None) is not None:
+            yield
+            return
+        self.local.outbox = []
+        try:
+            yield
+        finally:
+            self.flush()
+            self.local.outbox = None
+
+    def flush(self):
+        """Sends the operations collected by the batch of the current thread
+
+        A single operation is sent as is. Several operations are sent as a
+        batch operation.
+        """
+        outbox = getattr(self.local, "outbox", None)
+        if not outbox:
+            return
+        operations = coalesce_operations(outbox)
+        outbox.clear()
+        if len(operations) == 1:
+            self.transmit(operations[0])
+        else:
+            self.transmit({
+                "operation": "batch",
+                "instance": "<meta>",
+                "operations": operations,
+            })
+
     def sync_meta(self):
         """Sends list of loaders and instances to client"""
-        self.comm.send({
+        self.send({
             "operation": "sync-meta",
             "instance": "<meta>",
             "loaders": {
@@ -45,12 +154,17 @@ class KernelComm:
             },
         })
 
+    def save_instance(self, instance):
+        """Saves instance between its requests, so its history is not being changed"""
+        with self.scheduler.bot_lock(instance.bot):
+            return instance.save()
+
     def save_instances(self):
         """Saves instances and return a json to client"""
         instances = {}
-        for name, instance in self.chat_instances.items():
-            instances[name] = instance.save()
-        self.comm.send({
+        for name, instance in list(self.chat_instances.items()):
+            instances[name] = self.save_instance(instance)
+        self.send({
             "operation": "instances",
             "instance": "<meta>",
             "data": {
@@ -59,9 +173,33 @@ class KernelComm:
             }
         })
 
+    def send_stats(self):
+        """Sends statistics of instances to client"""
+        self.send({
+            "operation": "stats",
+            "instance": "<meta>",
+            "data": {
+                name: instance.stats()
+                for name, instance in list(self.chat_instances.items())
+            }
+        })
+
+    def retire(self, instances):
+        """Waits for the queued requests of instances and stops them from sending
+
+        Called on the META_LANE lane before instances are replaced or
+        removed. Requests still running after RETIRE_TIMEOUT finish without
+        sending.
+        """
+        instances = list(instances)
+        self.scheduler.wait(RETIRE_TIMEOUT, [instance.chat_name for instance in instances])
+        for instance in instances:
+            instance.retired = True
+
     def load_instances(self, data):
         """Loads instances and syncs chat"""
         base_mode = self.chat_instances["base"].mode
+        self.retire(self.chat_instances.values())
         self.chat_instances = {}
         for name, instance in data.get("instances", {}).items():
             self.chat_instances[name] = ChatInstance(self, name, instance["mode"])
@@ -76,42 +214,85 @@ class KernelComm:
 
     def receive(self, msg):
         """Receives requests"""
-        data = msg["content"]["data"]
+        with self.batch():
+            self.process_request(msg["content"]["data"])
+
+    def process_request(self, data):
+        """Schedules request on the lane of its instance, or on the META_LANE lane
+
+        While META_LANE requests are pending, requests of instances are
+        dispatched after them, so they reach the instances those requests
+        create. Autocomplete queries of existing instances are dispatched
+        right away.
+        """
         try:
             instance = data["instance"]
             if instance == "<meta>":
-                operation = data.get("operation", "")
-                if operation == "new-instance":
-                    chat_instance = self.chat_instances[data["name"]] = ChatInstance(
-                        self, data["name"], data.get("mode", "base")
-                    ).start_bot(data.get("data", {}))
-                    chat_instance.sync_chat("init")
-                    self.sync_meta()
-                elif operation == "refresh":
-                    self.sync_meta()
-                elif operation == "remove-instance":
-                    self.dead_instances.append(
-                        self.chat_instances[data["name"]].save()
-                    )
-                    del self.chat_instances[data["name"]]
-                    self.sync_meta()
-                elif operation == "save-instances":
-                    self.save_instances()
-                elif operation == "load-instances":
-                    self.load_instances(data["data"])
+                self.scheduler.submit_meta(self.process_meta, data)
                 return
-            instances = self.chat_instances.values()
+            if self.scheduler.busy(META_LANE) and not (
+                data.get("operation") == "autocomplete-query" and instance in self.chat_instances
+            ):
+                self.scheduler.submit_meta(self.dispatch, data)
+                return
+            self.dispatch(data)
+        except Exception:  # pylint: disable=broad-except
+            self.report_error(data)
+
+    def dispatch(self, data):
+        """Schedules request on the lanes of its instances"""
+        try:
+            instance = data["instance"]
+            instances = list(self.chat_instances.values())
             if instance != "<all>":
                 instances = [self.chat_instances.get(instance, None)]
             for chat_instance in instances:
-                chat_instance.receive(data)
+                if data.get("operation") == "autocomplete-query":
+                    # Autocomplete has its own dispatcher, ahead of queued requests
+                    chat_instance.receive(data)
+                else:
+                    self.scheduler.submit(chat_instance, chat_instance.receive, data)
         except Exception:  # pylint: disable=broad-except
-            print(traceback.format_exc())
-            self.chat_instances["base"].send({
-                "operation": "error",
-                "command": data.get("operation", "<operation undefined>"),
-                "message": traceback.format_exc(),
-            })
+            self.report_error(data)
+
+    def process_meta(self, data):
+        """Processes requests that manage instances"""
+        try:
+            operation = data.get("operation", "")
+            if operation == "new-instance":
+                if data["name"] in self.chat_instances:
+                    self.retire([self.chat_instances[data["name"]]])
+                chat_instance = self.chat_instances[data["name"]] = ChatInstance(
+                    self, data["name"], data.get("mode", "base")
+                ).start_bot(data.get("data", {}))
+                chat_instance.sync_chat("init")
+                self.sync_meta()
+            elif operation == "refresh":
+                self.sync_meta()
+            elif operation == "remove-instance":
+                self.retire([self.chat_instances[data["name"]]])
+                self.dead_instances.append(
+                    self.save_instance(self.chat_instances[data["name"]])
+                )
+                del self.chat_instances[data["name"]]
+                self.sync_meta()
+            elif operation == "save-instances":
+                self.save_instances()
+            elif operation == "load-instances":
+                self.load_instances(data["data"])
+            elif operation == "stats":
+                self.send_stats()
+        except Exception:  # pylint: disable=broad-except
+            self.report_error(data)
+
+    def report_error(self, data):
+        """Sends the traceback of a failed request to the base instance"""
+        print(traceback.format_exc())
+        self.chat_instances["base"].send({
+            "operation": "error",
+            "command": data.get("operation", "<operation undefined>"),
+            "message": traceback.format_exc(),
+        })
 
     def reply(self, text, type_="bot", reply=None, instance="base"):
         """Replies message to user"""
@@ -2,16 +2,18 @@
 from __future__ import annotations
 from typing import TYPE_CHECKING
 
+import itertools
+import time
 import uuid
+from collections.abc import Mapping
 from dataclasses import dataclass
-from datetime import datetime
 from enum import IntEnum
 
 
 
 if TYPE_CHECKING:
     from ..core.states.state import StateDefinition
-    from typing import Sequence, TypedDict
+    from typing import Any, Iterator, Sequence, TypedDict
 
     from .kernelcomm import KernelComm
     from .chat_instance import ChatInstance
@@ -56,6 +58,114 @@ class KernelProcess(IntEnum):
     FORCE = 2
 
 
+# Message ids combine a random prefix per kernel with a counter, so they stay
+# unique across kernel restarts without calling uuid4 for each message
+MESSAGE_ID_PREFIX = uuid.uuid4().hex[:12]
+_MESSAGE_COUNTER = itertools.count(1)
+
+MESSAGE_FIELDS = (
+    "id", "text", "type", "timestamp", "reply", "display",
+    "kernelProcess", "kernelDisplay", "feedback", "loading",
+)
+_FIELD_SET = frozenset(MESSAGE_FIELDS)
+# Feedback of the wire dicts of messages that were not rated
+_DEFAULT_FEEDBACK = {"rate": 0, "reason": "", "otherreason": ""}
+
+
+def new_message_id() -> str:
+    """Returns a new message id"""
+    return f"{MESSAGE_ID_PREFIX}-{next(_MESSAGE_COUNTER)}"
+
+
+class ChatMessage(Mapping):
+    """Compact message created by the kernel
+
+    Behaves as an IChatMessage dict: fields are read and written by key, and
+    keys that are not fields are kept in an extra dict. The feedback dict is
+    only created when it is accessed, and the wire dict is only built by
+    to_dict when the message is sent or saved.
+    """
+    # pylint: disable=invalid-name
+    __slots__ = MESSAGE_FIELDS + ("extra",)
+
+    def __init__(
+        self,
+        id_: str,
+        text: str,
+        type_: str,
+        timestamp: int,
+        reply: str | None = None,
+        display: int = 0,
+        kernel_process: int = 0,
+        kernel_display: int = 0,
+    ):
+        # pylint: disable=too-many-arguments
+        self.id = id_
+        self.text = text
+        self.type = type_
+        self.timestamp = timestamp
+        self.reply = reply
+        self.display = display
+        self.kernelProcess = kernel_process
+        self.kernelDisplay = kernel_display
+        self.feedback: dict | None = None
+        self.loading = False
+        self.extra: dict | None = None
+
+    def __getitem__(self, key: str) -> Any:
+        if key in _FIELD_SET:
+            if key == "feedback" and self.feedback is None:
+                self.feedback = {"rate": 0, "reason": "", "otherreason": ""}
+            return getattr(self, key)
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key in _FIELD_SET:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key: object) -> bool:
+        return key in _FIELD_SET or (self.extra is not None and key in self.extra)
+
+    def __iter__(self) -> Iterator[str]:
+        yield from MESSAGE_FIELDS
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self) -> int:
+        return len(MESSAGE_FIELDS) + len(self.extra or ())
+
+    def __repr__(self) -> str:
+        return f"ChatMessage({self.to_dict()!r})"
+
+    def to_dict(self) -> IChatMessage:
+        """Returns the wire dict of the message
+
+        Messages without feedback share a default feedback dict, so wire
+        dicts are only meant to be encoded.
+        """
+        result = {
+            "id": self.id,
+            "text": self.text,
+            "type": self.type,
+            "timestamp": self.timestamp,
+            "reply": self.reply,
+            "display": self.display,
+            "kernelProcess": self.kernelProcess,
+            "kernelDisplay": self.kernelDisplay,
+            "feedback": self.feedback if self.feedback is not None else _DEFAULT_FEEDBACK,
+            "loading": self.loading,
+        }
+        if self.extra:
+            result.update(self.extra)
+        return result
+
+
 @dataclass
 class MessageContext:
     """Represents a message context"""
@@ -70,31 +180,31 @@ class MessageContext:
         type_: str,
         reply: str | None = None,
         display: MessageDisplay = MessageDisplay.DEFAULT,
-    ) -> IChatMessage:
-        """Creates IChatMessage"""
-        return {
-            "id": str(uuid.uuid4()),
-            "text": text,
-            "type": type_,
-            "timestamp": int(datetime.timestamp(datetime.now())*1000),
-            "reply": reply,
-            "display": int(display),
-            "kernelProcess": int(KernelProcess.PREVENT),
-            "kernelDisplay": int(MessageDisplay.DEFAULT),
-            "feedback": {
-                "rate": 0,
-                "reason": "",
-                "otherreason": "",
-            },
-            "loading": False,
-        }
+    ) -> ChatMessage:
+        """Creates ChatMessage"""
+        return ChatMessage(
+            new_message_id(),
+            text,
+            type_,
+            int(time.time() * 1000),
+            reply,
+            int(display),
+            int(KernelProcess.PREVENT),
+            int(MessageDisplay.DEFAULT),
+        )
 
     @property
     def text(self):
         """Returns original message text"""
         return self.original_message['text']
 
-    def reply(self, message: str, type_: str="bot", checkpoint: StateDefinition | None = None):
+    def reply(
+        self,
+        message: str,
+        type_: str="bot",
+        checkpoint: StateDefinition | None = None,
+        loading: bool = False
+    ) -> ChatMessage:
         """Reply indicating the reply_to field"""
         message = self.create_message(
             message,
@@ -102,9 +212,11 @@ class MessageContext:
             self.original_message['id'],
             self.original_message['kernelDisplay']
         )
+        message['loading'] = loading
         if checkpoint is not None:
             self.instance.checkpoints[message['id']] = checkpoint
         self.instance.reply_message(message)
+        return message
 
     def reply_options(
         self,
@@ -0,0 +1,230 @@
+"""Defines the scheduler that processes chat instance requests in worker threads"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import os
+import threading
+import traceback
+import weakref
+
+if TYPE_CHECKING:
+    from typing import Any, Callable, ContextManager, Deque, Dict, Iterable, List, Tuple
+    from .chat_instance import ChatInstance
+
+
+# Number of worker threads. With 0, requests are processed in the comm callback
+WORKERS = int(os.environ.get("NEWTONCHAT_WORKERS", 4))
+# Maximum number of instances that process a replicated base chat message at once
+FANOUT_PARALLELISM = int(os.environ.get("NEWTONCHAT_FANOUT_PARALLELISM", 4))
+# Seconds an instance may take to process a replicated message before its slot is released
+FANOUT_TIMEOUT = float(os.environ.get("NEWTONCHAT_FANOUT_TIMEOUT", 60))
+# Seconds to wait for the queued requests of an instance before it is replaced or removed
+RETIRE_TIMEOUT = float(os.environ.get("NEWTONCHAT_RETIRE_TIMEOUT", 10))
+# Name of the lane of the requests that create, remove, save, or load instances
+META_LANE = "<meta>"
+
+
+class Lane:
+    """Queue of the requests of a chat instance, processed in order"""
+    __slots__ = ('tasks', 'running', 'counters')
+
+    def __init__(self):
+        self.tasks: Deque[Tuple[ChatInstance | None, Callable[..., Any], tuple]] = deque()
+        self.running = False
+        self.counters = {"submitted": 0, "processed": 0, "timeouts": 0}
+
+
+class InstanceScheduler:
+    """Processes the requests of each chat instance in order on worker threads
+
+    Requests of different instances run concurrently, except for instances
+    that share a bot, such as the Newton singleton. Those are serialized by
+    a lock of the bot, so bot states are never processed by two threads.
+    Autocomplete queries do not go through the scheduler, they have their
+    own dispatcher, so they are never queued behind pending messages. They
+    take the bot lock, so they only wait for the request being processed.
+    Requests that manage instances run in order on the META_LANE lane,
+    without a bot lock, so they never block the comm callback.
+    """
+
+    def __init__(self, context: Callable[[], ContextManager] = nullcontext, workers: int = WORKERS):
+        self.context = context
+        self.workers = workers
+        self.executor = None
+        if workers > 0:
+            self.executor = ThreadPoolExecutor(workers, thread_name_prefix="newtonchat-worker")
+        self.lanes: Dict[str, Lane] = {}
+        self.bot_locks: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self.condition = threading.Condition()
+
+    def submit(self, instance: ChatInstance, func: Callable[..., Any], *args) -> None:
+        """Schedules func(*args) after the pending requests of instance"""
+        self.enqueue(instance.chat_name, instance, func, args)
+
+    def submit_meta(self, func: Callable[..., Any], *args) -> None:
+        """Schedules func(*args) after the pending requests of the META_LANE lane"""
+        self.enqueue(META_LANE, None, func, args)
+
+    def enqueue(
+        self, name: str, instance: ChatInstance | None, func: Callable[..., Any], args: tuple
+    ) -> None:
+        """Appends a request to the lane of name and starts draining it if it is idle"""
+        if self.executor is None:
+            self.execute(instance, func, args)
+            return
+        with self.condition:
+            lane = self.lanes.setdefault(name, Lane())
+            lane.tasks.append((instance, func, args))
+            lane.counters["submitted"] += 1
+            if lane.running:
+                return
+            lane.running = True
+        self.executor.submit(self.drain, lane)
+
+    def busy(self, name: str) -> bool:
+        """Returns whether the lane of name has pending or running requests"""
+        with self.condition:
+            lane = self.lanes.get(name)
+            return lane is not None and lane.running
+
+    def fan_out(
+        self,
+        tasks: List[Tuple[ChatInstance, Callable[..., Any], tuple]],
+        parallelism: int = FANOUT_PARALLELISM,
+        timeout: float = FANOUT_TIMEOUT
+    ) -> FanOut:
+        """Schedules a request on several instances, at most parallelism at a time"""
+        fan_out = FanOut(self, tasks, parallelism, timeout)
+        fan_out.start()
+        return fan_out
+
+    def timed_out(self, instance: ChatInstance) -> None:
+        """Counts a fan-out timeout of an instance"""
+        with self.condition:
+            lane = self.lanes.setdefault(instance.chat_name, Lane())
+            lane.counters["timeouts"] += 1
+
+    def drain(self, lane: Lane) -> None:
+        """Processes the requests of a lane until it is empty"""
+        while True:
+            with self.condition:
+                if not lane.tasks:
+                    lane.running = False
+                    self.condition.notify_all()
+                    return
+                instance, func, args = lane.tasks.popleft()
+            self.execute(instance, func, args)
+            with self.condition:
+                lane.counters["processed"] += 1
+
+    def execute(self, instance: ChatInstance | None, func: Callable[..., Any], args: tuple) -> None:
+        """Runs a request in the scheduler context, holding the lock of the instance bot"""
+        try:
+            lock = nullcontext() if instance is None else self.bot_lock(instance.bot)
+            with self.context(), lock:
+                func(*args)
+        except Exception:  # pylint: disable=broad-except
+            print(traceback.format_exc())
+
+    def bot_lock(self, bot) -> threading.RLock:
+        """Returns the lock that serializes the requests of a bot"""
+        with self.condition:
+            lock = self.bot_locks.get(bot)
+            if lock is None:
+                lock = self.bot_locks[bot] = threading.RLock()
+            return lock
+
+    def wait(self, timeout: float | None = None, names: Iterable[str] | None = None) -> bool:
+        """Waits until the lanes of names, or all lanes, are idle. Returns False on timeout"""
+        names = None if names is None else set(names)
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: not any(
+                    lane.running for name, lane in self.lanes.items()
+                    if names is None or name in names
+                ),
+                timeout
+            )
+
+    def stats(self, chat_name: str) -> dict:
+        """Returns request counters of an instance"""
+        with self.condition:
+            lane = self.lanes.get(chat_name)
+            if lane is None:
+                return {"pending": 0, "submitted": 0, "processed": 0, "timeouts": 0}
+            return {"pending": len(lane.tasks), **lane.counters}
+
+
+class FanOut:
+    """Delivers a request to several instances through their lanes
+
+    At most parallelism instances process the request at once. Each one
+    sends its replies as soon as it is done, without waiting for the
+    others. An instance that does not finish within timeout seconds gets
+    an error notice and releases its slot, so the next instance can start.
+    Threads cannot be interrupted, so the slow instance still sends its
+    reply when it is done.
+    """
+
+    def __init__(
+        self,
+        scheduler: InstanceScheduler,
+        tasks: List[Tuple[ChatInstance, Callable[..., Any], tuple]],
+        parallelism: int,
+        timeout: float
+    ):
+        self.scheduler = scheduler
+        self.pending = deque(tasks)
+        self.parallelism = max(parallelism, 1)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
+        """Starts the first instances"""
+        for _ in range(self.parallelism):
+            self.next()
+
+    def next(self) -> None:
+        """Schedules the next pending instance, if any"""
+        with self.lock:
+            if not self.pending:
+                return
+            instance, func, args = self.pending.popleft()
+        self.scheduler.submit(instance, self.run, instance, func, args)
+
+    def run(self, instance: ChatInstance, func: Callable[..., Any], args: tuple) -> None:
+        """Processes the request of an instance, releasing its slot on completion or timeout"""
+        slot = {"released": False}
+        timer = None
+        if self.timeout > 0:
+            timer = threading.Timer(self.timeout, self.expire, (instance, slot))
+            timer.daemon = True
+            timer.start()
+        try:
+            func(*args)
+        finally:
+            if timer is not None:
+                timer.cancel()
+            self.release(slot)
+
+    def release(self, slot: dict) -> None:
+        """Frees a slot once and starts the next instance"""
+        with self.lock:
+            if slot["released"]:
+                return
+            slot["released"] = True
+        self.next()
+
+    def expire(self, instance: ChatInstance, slot: dict) -> None:
+        """Notifies that an instance is taking too long and frees its slot"""
+        self.scheduler.timed_out(instance)
+        instance.send({
+            "operation": "error",
+            "command": "message",
+            "message": (f"Instance {instance.chat_name} did not reply within "
+                        f"{self.timeout:g} seconds. Its reply will arrive when it is ready"),
+        })
+        self.release(slot)
@@ -0,0 +1,149 @@
+"""Defines the fast JSON encoder of comm payloads
+
+Large payloads, such as full histories and saved instances, are encoded
+here and sent as a comm buffer, instead of being encoded by the kernel
+session on every send. Chat messages and lists of chat messages are
+encoded in a single orjson call when orjson is installed. Otherwise, or
+when a message cannot be encoded by orjson, the standard library encodes
+them.
+
+The output is byte-identical to
+json.dumps(data, ensure_ascii=False, separators=(",", ":"), allow_nan=False)
+encoded as UTF-8, with or without orjson. orjson formats some floats
+differently and encodes types that the standard library rejects, so it
+only encodes messages whose values are strings, ints, bools, None, or
+dicts of those.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from itertools import chain
+import json
+
+from .message import ChatMessage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if TYPE_CHECKING:
+    from typing import Any, List, Sequence
+
+
+SCALAR_TYPES = frozenset((str, int, bool, type(None)))
+
+_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), allow_nan=False)
+
+
+def dumps(obj: Any) -> bytes:
+    """Encodes obj with the standard library"""
+    return _ENCODER.encode(obj).encode('utf-8')
+
+
+def is_message(obj: Any) -> bool:
+    """Checks if obj is a chat message"""
+    return type(obj) is dict and "id" in obj and "text" in obj and "type" in obj
+
+
+def to_wire(data: Any) -> Any:
+    """Replaces ChatMessage objects in a payload by their wire dicts
+
+    Containers are copied only if they hold ChatMessage objects, so plain
+    payloads are returned as they are. Dict messages are not traversed,
+    since they only hold scalars and the feedback dict.
+    """
+    kind = type(data)
+    if kind is ChatMessage:
+        return data.to_dict()
+    if kind is dict:
+        if is_message(data):
+            return data
+        result = data
+        for key, value in data.items():
+            wire = to_wire(value)
+            if wire is not value:
+                if result is data:
+                    result = dict(data)
+                result[key] = wire
+        return result
+    if kind is list or kind is tuple:
+        result = data
+        for position, value in enumerate(data):
+            value_kind = type(value)
+            if value_kind is ChatMessage:
+                wire = value.to_dict()
+            elif value_kind in SCALAR_TYPES or value_kind is dict and is_message(value):
+                continue
+            else:
+                wire = to_wire(value)
+                if wire is value:
+                    continue
+            if result is data:
+                result = list(data)
+            result[position] = wire
+        return result
+    return data
+
+
+def is_plain(messages: Sequence[dict]) -> bool:
+    """Checks if all values of messages are scalars or dicts of scalars
+
+    The types are collected with iterators instead of a loop per message,
+    since the check runs on whole histories.
+    """
+    values = list(chain.from_iterable(map(dict.values, messages)))
+    types = set(map(type, values))
+    if types <= SCALAR_TYPES:
+        return True
+    if types - SCALAR_TYPES != {dict}:
+        return False
+    nested = [value for value in values if type(value) is dict]
+    return set(map(type, chain.from_iterable(map(dict.values, nested)))) <= SCALAR_TYPES
+
+
+def encode_payload(data: Any) -> bytes:
+    """Encodes payload, using orjson for lists of chat messages"""
+    if orjson is None:
+        return dumps(data)
+    parts: List[bytes] = []
+    _encode(data, parts)
+    return b"".join(parts)
+
+
+def _encode(obj: Any, parts: List[bytes]) -> None:
+    if is_message(obj):
+        # Strip the brackets of the encoded list
+        parts.append(_encode_messages([obj])[1:-1])
+    elif type(obj) is dict and all(type(key) is str for key in obj):
+        parts.append(b"{")
+        for position, (key, value) in enumerate(obj.items()):
+            if position:
+                parts.append(b",")
+            parts.append(dumps(key))
+            parts.append(b":")
+            _encode(value, parts)
+        parts.append(b"}")
+    elif type(obj) is list and obj and all(map(is_message, obj)):
+        parts.append(_encode_messages(obj))
+    elif type(obj) in (list, tuple):
+        parts.append(b"[")
+        for position, value in enumerate(obj):
+            if position:
+                parts.append(b",")
+            _encode(value, parts)
+        parts.append(b"]")
+    else:
+        parts.append(dumps(obj))
+
+
+def _encode_messages(messages: List[dict]) -> bytes:
+    """Encodes a list of messages"""
+    if is_plain(messages):
+        try:
+            return orjson.dumps(messages)
+        except orjson.JSONEncodeError:
+            # Integers beyond 64 bits
+            pass
+    return dumps(messages)
@@ -1,9 +1,24 @@
+import functools
 import json
 import sys
 
 from jupyter_server.base.handlers import APIHandler
 from jupyter_server.utils import url_path_join
 import tornado
+from tornado.ioloop import IOLoop
+
+from .shared_index import shared_index_path, shared_index_service
+
+
+@functools.lru_cache(maxsize=None)
+def restrict_config():
+    """Returns the restrictions passed to the server. The arguments do not change"""
+    restrict = []
+    for arg in sys.argv:
+        if arg.startswith('--Newtonchat.restrict='):
+            restrict = arg[len('--Newtonchat.restrict='):].strip('"').strip("'").split(',')
+    return restrict
+
 
 class RouteHandler(APIHandler):
     # The following decorator should be present on all verb methods (head, get, post,
@@ -11,19 +26,69 @@ class RouteHandler(APIHandler):
     # Jupyter server
     @tornado.web.authenticated
     def get(self):
-        restrict = []
-        for arg in sys.argv:
-            if arg.startswith('--Newtonchat.restrict='):
-                restrict = arg[len('--Newtonchat.restrict='):].strip('"').strip("'").split(',')
         self.finish(json.dumps({
-            'restrict': restrict
+            'restrict': restrict_config(),
+            'shared_index': shared_index_path() is not None,
         }))
 
 
+class IndexHandler(APIHandler):
+    """Base handler for queries to the subject index of the server process
+
+    Answers only when the shared index is enabled. Otherwise, kernels answer
+    with their own index, which follows their config and data reloads.
+    """
+
+    def get_limit(self, default, maximum=50):
+        """Returns the limit argument, bounded by maximum"""
+        try:
+            limit = int(self.get_argument('limit', str(default)))
+        except ValueError as exc:
+            raise tornado.web.HTTPError(400, "limit must be an integer") from exc
+        return max(0, min(limit, maximum))
+
+    async def query(self, func):
+        """Runs func with the index service in a thread, since the first query loads the index"""
+        if shared_index_path() is None:
+            raise tornado.web.HTTPError(404, "The shared index is disabled")
+        try:
+            return await IOLoop.current().run_in_executor(
+                None, lambda: func(shared_index_service())
+            )
+        except ValueError as exc:
+            raise tornado.web.HTTPError(400, str(exc)) from exc
+
+
+class SearchHandler(IndexHandler):
+    """Searches subjects: GET newtonchat/search?query=...&limit=...&backend=..."""
+
+    @tornado.web.authenticated
+    async def get(self):
+        query = self.get_argument('query', '')
+        limit = self.get_limit(10)
+        backend = self.get_argument('backend', None)
+        matches = await self.query(lambda service: service.search(query, limit, backend))
+        self.finish(json.dumps({'matches': matches}))
+
+
+class AutocompleteHandler(IndexHandler):
+    """Autocompletes subjects: GET newtonchat/autocomplete?query=...&limit=..."""
+
+    @tornado.web.authenticated
+    async def get(self):
+        query = self.get_argument('query', '')
+        limit = self.get_limit(5)
+        items = await self.query(lambda service: service.autocomplete(query, limit))
+        self.finish(json.dumps({'items': items}))
+
+
 def setup_handlers(web_app):
     host_pattern = ".*$"
 
     base_url = web_app.settings["base_url"]
-    route_pattern = url_path_join(base_url, "newtonchat", "config")
-    handlers = [(route_pattern, RouteHandler)]
+    handlers = [
+        (url_path_join(base_url, "newtonchat", "config"), RouteHandler),
+        (url_path_join(base_url, "newtonchat", "search"), SearchHandler),
+        (url_path_join(base_url, "newtonchat", "autocomplete"), AutocompleteHandler),
+    ]
     web_app.add_handlers(host_pattern, handlers)
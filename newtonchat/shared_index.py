@@ -0,0 +1,256 @@
+"""Defines the shared subject index served by the Jupyter server extension
+
+When NEWTONCHAT_SHARED_INDEX is set, the server extension loads a single
+subject index and answers search and autocomplete queries of all kernels
+of the host over a Unix socket. Kernels use SharedIndexClient and fall back
+to their own index while the server is unavailable.
+
+NEWTONCHAT_SHARED_INDEX may be 1, to use a socket in the cache directory,
+or the path of the socket.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from pathlib import Path
+import hashlib
+import importlib.resources
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from .bots.storage import cache
+
+
+if TYPE_CHECKING:
+    from typing import Any, Dict, List, Tuple
+
+
+# Seconds a kernel waits for the server before falling back to its own index
+TIMEOUT = float(os.environ.get("NEWTONCHAT_SHARED_INDEX_TIMEOUT", 1))
+# Seconds a kernel uses its own index after the server failed
+RETRY_INTERVAL = 30
+
+
+def shared_index_path() -> Path | None:
+    """Returns the socket path of the shared index, or None if it is disabled"""
+    value = os.environ.get("NEWTONCHAT_SHARED_INDEX", "")
+    if value in ("", "0"):
+        return None
+    if value != "1":
+        return Path(value)
+    # Kernels and the server resolve the same data directory
+    data = importlib.resources.files(__package__) / 'data'
+    digest = hashlib.sha256(str(data).encode('utf-8')).hexdigest()[:16]
+    return cache() / f"index-{digest}.sock"
+
+
+class SharedIndexClient:
+    """Queries the shared index server
+
+    Methods return None when the server does not answer, so callers can
+    fall back to a local index. After a failure, the server is only tried
+    again after RETRY_INTERVAL seconds.
+    """
+
+    def __init__(self, path: Path, timeout: float = TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.connection: socket.socket | None = None
+        self.reader = None
+        self.retry_at = 0.0
+
+    def request(self, payload: Dict[str, Any]) -> Dict[str, Any] | None:
+        """Sends request and returns the response"""
+        if time.monotonic() < self.retry_at:
+            return None
+        with self.lock:
+            try:
+                if self.connection is None:
+                    self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    self.connection.settimeout(self.timeout)
+                    self.connection.connect(str(self.path))
+                    self.reader = self.connection.makefile('rb')
+                self.connection.sendall(json.dumps(payload).encode('utf-8') + b"\n")
+                line = self.reader.readline()
+                if not line:
+                    raise ConnectionError("Shared index closed the connection")
+                response = json.loads(line)
+                if 'error' in response:
+                    raise ValueError(response['error'])
+                return response
+            except (OSError, ValueError):
+                self.close()
+                self.retry_at = time.monotonic() + RETRY_INTERVAL
+                return None
+
+    def close(self) -> None:
+        """Closes connection"""
+        try:
+            if self.reader is not None:
+                self.reader.close()
+            if self.connection is not None:
+                self.connection.close()
+        except OSError:
+            pass
+        self.connection = None
+        self.reader = None
+
+    def search(self, text: str, limit: int | None, backend: str) -> List[dict] | None:
+        """Returns {'ref', 'score'} matches of the best subjects"""
+        response = self.request({
+            "operation": "search", "text": text, "limit": limit, "backend": backend
+        })
+        return None if response is None else response['matches']
+
+    def complete(self, text: str, limit: int) -> List[str] | None:
+        """Returns keys of the subjects that start with the words of text"""
+        response = self.request({"operation": "complete", "text": text, "limit": limit})
+        return None if response is None else response['keys']
+
+
+_CLIENT: SharedIndexClient | None = None
+
+
+def shared_index_client() -> SharedIndexClient | None:
+    """Returns the client of the kernel, or None if the shared index is disabled"""
+    # pylint: disable=global-statement
+    global _CLIENT
+    path = shared_index_path()
+    if path is None:
+        return None
+    if _CLIENT is None or _CLIENT.path != path:
+        _CLIENT = SharedIndexClient(path)
+    return _CLIENT
+
+
+class SharedIndexService:
+    """Answers queries with a subject handler that belongs to the server process"""
+
+    def __init__(self):
+        # pylint: disable=import-outside-toplevel
+        from .bots.newton.handlers.subject import SubjectHandler
+        self.handler = SubjectHandler()
+        self.lock = threading.Lock()
+
+    def search(self, text: str, limit: int | None, backend: str | None = None) -> List[dict]:
+        """Returns {'ref', 'score', 'label'} matches of the best subjects"""
+        # pylint: disable=import-outside-toplevel
+        from .bots.newton.handlers.search import BACKENDS, DEFAULT_BACKEND, backend_name
+        from .bots.newton.handlers.subject import subject_name
+        backend = backend or DEFAULT_BACKEND
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend}")
+        backend = backend_name(backend)
+        with self.lock:
+            self.handler.check_updates()
+            matches = self.handler.search(text, limit, backend)
+        return [{
+            'ref': match['ref'],
+            'score': match['score'],
+            'label': subject_name(node, match['ref']),
+        } for match, node in matches]
+
+    def complete(self, text: str, limit: int) -> List[Tuple[str, dict]]:
+        """Returns (key, node) pairs of subjects that start with the words of text"""
+        with self.lock:
+            self.handler.check_updates()
+            return self.handler.complete(text, limit)
+
+    def autocomplete(self, text: str, limit: int) -> List[dict]:
+        """Returns autocomplete items in the format of autocomplete-response operations"""
+        # pylint: disable=import-outside-toplevel
+        from .bots.newton.autocomplete import autocomplete_items
+        return autocomplete_items(self.complete(text, limit))
+
+    def process(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Processes socket request"""
+        operation = request.get("operation")
+        if operation == "ping":
+            return {}
+        if operation == "search":
+            matches = self.search(request["text"], request.get("limit"), request["backend"])
+            return {"matches": matches}
+        if operation == "complete":
+            return {"keys": [key for key, _ in self.complete(request["text"], request["limit"])]}
+        return {"error": f"Unknown operation {operation}"}
+
+
+_SERVICE: SharedIndexService | None = None
+_SERVICE_LOCK = threading.Lock()
+
+
+def shared_index_service() -> SharedIndexService:
+    """Returns the index service of the server process, loading it on first use"""
+    # pylint: disable=global-statement
+    global _SERVICE
+    with _SERVICE_LOCK:
+        if _SERVICE is None:
+            _SERVICE = SharedIndexService()
+        return _SERVICE
+
+
+class _SharedIndexRequestHandler(socketserver.StreamRequestHandler):
+    """Reads one JSON request per line and writes one JSON response per line"""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.service.process(json.loads(line))
+            except Exception as exc:  # pylint: disable=broad-except
+                response = {"error": repr(exc)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b"\n")
+
+
+class SharedIndexServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server of the shared index"""
+    daemon_threads = True
+
+    def __init__(self, path: Path, service: SharedIndexService):
+        self.path = path
+        self.service = service
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.exists():
+            if SharedIndexClient(path).request({"operation": "ping"}) is not None:
+                raise OSError(f"Shared index already served at {path}")
+            path.unlink()
+        super().__init__(str(path), _SharedIndexRequestHandler)
+        os.chmod(path, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            self.path.unlink()
+        except OSError:
+            pass
+
+
+def start_shared_index(log=None) -> threading.Thread | None:
+    """Loads the shared index and serves it in a daemon thread
+
+    Returns None if the shared index is disabled
+    """
+    path = shared_index_path()
+    if path is None:
+        return None
+
+    def serve():
+        try:
+            server = SharedIndexServer(path, shared_index_service())
+        except Exception:  # pylint: disable=broad-except
+            if log is not None:
+                log.exception("Could not start newtonchat shared index")
+            return
+        if log is not None:
+            log.info("Serving newtonchat shared index at %s", path)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+    thread = threading.Thread(target=serve, name="newtonchat-shared-index", daemon=True)
+    thread.start()
+    return thread
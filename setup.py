@@ -23,7 +23,10 @@ install_requires = [
 ]
 
 extra_require = {
-    "dev": ["pyinotify"]
+    "dev": ["pyinotify"],
+    "gpt": ["requests"],
+    "bm25": ["numpy"],
+    "fastjson": ["orjson"],
 }
 
 # The name of the project
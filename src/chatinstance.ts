@@ -2,12 +2,20 @@ import { get, writable, type Writable } from "svelte/store";
 import { MessageDisplay, type IAutoCompleteItem, type IChatMessage, type IConfigVar, type Subset } from "./common/chatbotInterfaces";
 import { checkTarget, cloneMessage, messageTarget } from "./common/messages";
 import type { NotebookCommModel } from "./dataAPI/NotebookCommModel";
-import { replying, wizardMode, wizardPreviewMessage } from "./stores";
+import { requestAPI } from "./server";
+import { replying, sharedIndex, wizardMode, wizardPreviewMessage } from "./stores";
 
 export function createChatInstance(model: NotebookCommModel, chatName: string, mode: string) {
     let current: IChatMessage[] = [];
+    let epoch: string | null = null;
+    // Revision of the last sync. The kernel resends messages that changed after it
+    let revision: number | null = null;
+    let historyOffset = writable(0);
     let autoCompleteResponseId = writable(-1); 
     let autoCompleteItems: Writable<IAutoCompleteItem[]> = writable<IAutoCompleteItem[]>([]);
+    // Only the latest autocomplete request is answered. Older HTTP requests are aborted
+    let latestAutoCompleteId = -1;
+    let autoCompleteController: AbortController | null = null;
     let configMap: { [id: string]: IConfigVar<any>} = {};
   
     function createConfigVar<T>(name: string, value: T) {
@@ -66,20 +74,67 @@ export function createChatInstance(model: NotebookCommModel, chatName: string, m
       model.sendMessageKernel(chatName, newMessage);
     }
   
-    function load(data: IChatMessage[]) {
-      current = data;
+    function mapMessages() {
       messageMap = {};
       current.forEach((message, index) => {
         messageMap[message['id']] = { position: index, message: message };
       });
-      const lastMessage = data[data.length - 1];
-      if ((get(wizardMode) != (lastMessage.type != 'user')) && !['kernel', 'build'].includes(checkTarget(lastMessage))) {
+    }
+
+    function load(
+      data: IChatMessage[],
+      since: number = 0,
+      newEpoch: string | null = null,
+      newRevision: number | null = null,
+      updated: IChatMessage[] | null = []
+    ) {
+      const offset = get(historyOffset);
+      // Without updated, the kernel could not tell which older messages changed
+      if (updated !== null && newEpoch === epoch && since >= offset && since <= offset + current.length) {
+        current = [...current.slice(0, since - offset), ...data];
+      } else {
+        current = data;
+        historyOffset.set(since);
+      }
+      epoch = newEpoch;
+      revision = newRevision;
+      mapMessages();
+      for (const message of updated ?? []) {
+        if (messageMap[message['id']] !== undefined) {
+          const { position } = messageMap[message['id']];
+          current[position] = message;
+          messageMap[message['id']] = { position, message };
+        }
+      }
+      const lastMessage = current[current.length - 1];
+      if (lastMessage && (get(wizardMode) != (lastMessage.type != 'user')) && !['kernel', 'build'].includes(checkTarget(lastMessage))) {
         replying.set(lastMessage['id']);
       }
       set(current);
     }
   
+    function loadPage(data: IChatMessage[], since: number, newEpoch: string | null) {
+      if (newEpoch !== epoch || since + data.length !== get(historyOffset)) {
+        refresh();
+        return;
+      }
+      current = [...data, ...current];
+      historyOffset.set(since);
+      mapMessages();
+      set(current);
+    }
+
+    function loadOlder() {
+      const offset = get(historyOffset);
+      if (offset > 0) {
+        model.sendHistoryPage(chatName, offset);
+      }
+    }
+
     function updateMessage(message: IChatMessage) {
+      if (messageMap[message['id']] === undefined) {
+        return;
+      }
       let { position } = messageMap[message['id']];
       current[position] = message;
       messageMap[message['id']] = { position, message };
@@ -99,7 +154,12 @@ export function createChatInstance(model: NotebookCommModel, chatName: string, m
   
     function reset() {
       current = [];
+      epoch = null;
+      revision = null;
+      historyOffset.set(0);
       messageMap = {};
+      autoCompleteController?.abort();
+      autoCompleteController = null;
       autoCompleteResponseId.set(-1);
       autoCompleteItems.set([]);
       set(current);
@@ -117,12 +177,41 @@ export function createChatInstance(model: NotebookCommModel, chatName: string, m
     }
   
     function sendAutoComplete(requestId: number, query: string) {
-      model.sendAutoCompleteQuery(chatName, requestId, query);
+      autoCompleteController?.abort();
+      autoCompleteController = null;
+      latestAutoCompleteId = requestId;
+      if (mode !== 'newton' || !get(sharedIndex) || !get(config.enableAutoComplete)) {
+        model.sendAutoCompleteQuery(chatName, requestId, query);
+        return;
+      }
+      // The server answers from the shared index, without a kernel round trip
+      const controller = new AbortController();
+      autoCompleteController = controller;
+      const params = new URLSearchParams({ query });
+      requestAPI<{ items: IAutoCompleteItem[] }>(`autocomplete?${params}`, {
+        method: 'GET',
+        signal: controller.signal
+      }).then((response) => {
+        if (requestId !== latestAutoCompleteId) {
+          return;
+        }
+        autoCompleteResponseId.set(requestId);
+        autoCompleteItems.set(response.items);
+      }).catch(() => {
+        if (controller.signal.aborted || requestId !== latestAutoCompleteId) {
+          return;
+        }
+        model.sendAutoCompleteQuery(chatName, requestId, query);
+      });
     }
   
     function refresh() {
       console.log("refresh", chatName)
-      model.sendRefreshInstance(chatName);
+      if (epoch !== null && current.length > 0) {
+        model.sendSyncSince(chatName, epoch, get(historyOffset) + current.length, revision);
+      } else {
+        model.sendRefreshInstance(chatName);
+      }
     }
   
     return {
@@ -134,6 +223,8 @@ export function createChatInstance(model: NotebookCommModel, chatName: string, m
       push,
       addNew,
       load,
+      loadPage,
+      loadOlder,
       submitSyncMessage,
       updateMessage,
       removeLoading,
@@ -145,7 +236,8 @@ export function createChatInstance(model: NotebookCommModel, chatName: string, m
       configMap,
       config,
       autoCompleteResponseId,
-      autoCompleteItems
+      autoCompleteItems,
+      historyOffset
     };
   }
 
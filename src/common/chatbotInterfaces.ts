@@ -74,6 +74,7 @@ export interface IAutoCompleteItem {
 
 export interface IServerConfig {
   restrict: string[];
+  shared_index?: boolean;
 }
 
 export type IMessagePartType =
@@ -26,6 +26,8 @@ import type { KernelMessage } from '@jupyterlab/services';
 import type { IErrorMsg } from '@jupyterlab/services/lib/kernel/messages';
 import { createChatInstance, type IChatInstance } from '../chatinstance';
 
+const TEXT_DECODER = new TextDecoder();
+
 export class NotebookCommModel {
   private _sessionContext: ISessionContext;
   public _notebook: NotebookPanel;
@@ -33,6 +35,7 @@ export class NotebookCommModel {
   private _language: IKernelMatcher;
   public chatInstances: Writable<{ [id: string]: IChatInstance }>;
   public chatLoaders: Writable<{ [id: string]: ILoaderForm }>;
+  public kernelStats: Writable<{ [id: string]: any }>;
   /*private _boundQueryCall: (
     sess: ISessionContext,
     args: KernelMessage.IMessage<KernelMessage.MessageType>
@@ -47,6 +50,7 @@ export class NotebookCommModel {
       "base": createChatInstance(this, "base", "newton") // Passing this here may cause a memory leak, but I haven't checked
     });
     this.chatLoaders = writable({});
+    this.kernelStats = writable({});
     //this._boundQueryCall = this._queryCall.bind(this);
   }
 
@@ -240,6 +244,16 @@ export class NotebookCommModel {
     });
   }
 
+  /**
+   * Send a stats request to the kernel
+   */
+  public sendRequestStats(): void {
+    this.send({
+      operation: 'stats',
+      instance: '<meta>'
+    });
+  }
+
   /**
    * Send a save command to the kernel
    */
@@ -262,6 +276,31 @@ export class NotebookCommModel {
     });
   }
 
+  /**
+   * Send a command to the kernel to get messages after the sequence number since,
+   * and the older messages that changed after revision
+   */
+  public sendSyncSince(instance: string, epoch: string, since: number, revision: number | null): void {
+    this.send({
+      operation: 'sync-since',
+      instance,
+      epoch,
+      since,
+      revision
+    });
+  }
+
+  /**
+   * Send a command to the kernel to get messages before the sequence number before
+   */
+  public sendHistoryPage(instance: string, before: number): void {
+    this.send({
+      operation: 'history-page',
+      instance,
+      before
+    });
+  }
+
   /**
    * Send a config command to the kernel
    */
@@ -377,15 +416,32 @@ export class NotebookCommModel {
     msg: KernelMessage.ICommMsgMsg
   ): void | PromiseLike<void> {
     try {
+      if (msg.content.data.encoding === 'json-buffer' && msg.buffers?.length) {
+        // Large payloads are encoded by the kernel and sent as a buffer
+        const data = JSON.parse(TEXT_DECODER.decode(msg.buffers[0])) as JSONObject;
+        return this._receiveNewtonQuery({ ...msg, content: { ...msg.content, data }, buffers: [] });
+      }
+
       const operation = msg.content.data.operation;
       const instance = msg.content.data.instance as string;
 
+      if (operation === 'batch') {
+        // The kernel coalesces the operations sent while processing a request
+        for (const data of msg.content.data.operations as unknown as JSONObject[]) {
+          this._receiveNewtonQuery({ ...msg, content: { ...msg.content, data } });
+        }
+        return;
+      }
+
       if (instance === "<meta>") {
         if (operation === 'sync-meta') {
           this.chatLoaders.set(msg.content.data.loaders as unknown as { [id: string]: ILoaderForm });
           const instances = msg.content.data.instances as unknown as { [id: string]: string };
           this._loadInstances(instances);
         }
+        if (operation === 'stats') {
+          this.kernelStats.set(msg.content.data.data as unknown as { [id: string]: any });
+        }
         if (operation === 'instances') {
           if (get(wizardMode)) {
             const a = document.createElement('a');
@@ -414,8 +470,23 @@ export class NotebookCommModel {
       if (operation === 'init' || operation === 'refresh') {
         kernelStatus.setattr('hasKernel', true);
         console.log("Load", instance, msg.content.data)
-        chatInstance.load(msg.content.data.history as unknown as IChatMessage[]);        
+        chatInstance.load(
+          msg.content.data.history as unknown as IChatMessage[],
+          (msg.content.data.since as number) || 0,
+          (msg.content.data.epoch as string) || null,
+          (msg.content.data.revision as number) ?? null,
+          // null: the kernel dropped the changes after revision and resends the window
+          msg.content.data.updated === null
+            ? null
+            : (msg.content.data.updated as unknown as IChatMessage[]) || []
+        );
         this._loadInstanceConfig(chatInstance, msg.content.data.config as unknown as { [id: string]: any });
+      } else if (operation === 'history-page') {
+        chatInstance.loadPage(
+          msg.content.data.history as unknown as IChatMessage[],
+          (msg.content.data.since as number) || 0,
+          (msg.content.data.epoch as string) || null
+        );
       } else if (operation === 'reply') {
         kernelStatus.setattr('hasKernel', true);
         const message: IChatMessage = msg.content.data
@@ -10,7 +10,7 @@ import { IRenderMimeRegistry } from '@jupyterlab/rendermime';
 import { MainChat } from './mainchat';
 import type { IServerConfig } from './common/chatbotInterfaces';
 import { requestAPI } from './server';
-import { restrictNotebooks, errorHandler, jupyterapp, jupyterSanitizer, jupyterRenderMime } from './stores';
+import { restrictNotebooks, sharedIndex, errorHandler, jupyterapp, jupyterSanitizer, jupyterRenderMime } from './stores';
 
 
 function startPlugin(
@@ -25,6 +25,7 @@ function startPlugin(
   try {
     console.log("Restrict: %s", config.restrict)
     restrictNotebooks.set(config.restrict);
+    sharedIndex.set(config.shared_index ?? false);
     jupyterapp.set(app);
     jupyterSanitizer.set(sanitizer);
     jupyterRenderMime.set(rendermime);
@@ -164,6 +164,7 @@ function createPanelWidget() {
 // ~~~~~~~~~~~ Stores ~~~~~~~~~~~~~~~~
 export const replying: Writable<string | null> = writable(null);
 export const restrictNotebooks: Writable<string[]> = writable([]);
+export const sharedIndex: Writable<boolean> = writable(false);
 export const jupyterapp: Writable<JupyterFrontEnd | null> = writable(null);
 export const jupyterSanitizer: Writable<ISanitizer | null> = writable(null);
 export const jupyterRenderMime: Writable<IRenderMimeRegistry | null> = writable(null);